@@ -1,77 +1,133 @@
-import asyncio
+import time
 import threading
 import logging
-from datetime import datetime
-from typing import List, Tuple, Any
+from datetime import datetime, timedelta
+from typing import List, Tuple, Any, Optional, Callable
 
 import pandas as pd
 import dash
 import dash_html_components as html
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output
+from dash.exceptions import PreventUpdate
 
 from src import config as cfg
 from src import plots
-from src.preprocessing import TextProcessor
-from src.entities_extractor import EntitiesExtractor
+from src import migrations
 from src.postgres import Storage
+from src.snapshot import DataSnapshot, SnapshotLoader
+from src.snapshot_store import SnapshotStore
+from src.figures_cache import FiguresCache
 from src.layout import Layout
 
 logging.basicConfig(level=logging.INFO)
+start_time = time.time()
 app = dash.Dash(
     'VK News',
     meta_tags=[{"name": "viewport", "content": "width=device-width"}],
     external_stylesheets=[dbc.themes.BOOTSTRAP],
-    serve_locally=True
+    serve_locally=True,
+    suppress_callback_exceptions=True
 )
 
 server = app.server
 app.title = 'VK News Dashboard'
 
-extractor = EntitiesExtractor()
-storage = Storage.connect(
-    dbname=cfg.PG_NAME,
-    user=cfg.PG_USER,
-    password=cfg.PG_PASS,
-    host=cfg.PG_HOST,
-    port=cfg.PG_PORT)
-
-posts = storage.get_posts()
-groups = storage.get_groups()
-entities = storage.get_entities()
-
-posts_df = TextProcessor.parse_posts(posts)
-groups_df = TextProcessor.parse_groups(groups)
-entities_df = TextProcessor.parse_entities(entities)
-
-layout = Layout(groups=list(groups_df['name'].values), data_update_interval=cfg.DATA_UPDATING_INTERVAL)
-
-app.layout = html.Div([
-    layout.Navbar,
-    dbc.Row([
-        dbc.Col([
-            layout.GroupCard,
-            layout.NewsCard
+cache: Optional[SnapshotStore] = None
+cached: Optional[DataSnapshot] = None
+if cfg.SNAPSHOT_DIR:
+    store = SnapshotStore(cfg.SNAPSHOT_DIR)
+    snapshots = store.follow(poll_interval=cfg.SNAPSHOT_POLL_INTERVAL)
+else:
+    storage = Storage.connect(
+        dbname=cfg.PG_NAME,
+        user=cfg.PG_USER,
+        password=cfg.PG_PASS,
+        host=cfg.PG_HOST,
+        port=cfg.PG_PORT,
+        itersize=cfg.PG_ITERSIZE,
+        copy_chunk_size=cfg.PG_COPY_CHUNK_SIZE,
+        minconn=cfg.PG_POOL_MIN,
+        maxconn=cfg.PG_POOL_MAX,
+        retries=cfg.PG_RETRIES,
+        backoff=cfg.PG_BACKOFF)
+    logging.info('Connected to Postgres in %.1fs' % (time.time() - start_time))
+    migrations.migrate(storage)
+    if cfg.SNAPSHOT_CACHE_DIR:
+        cache = SnapshotStore(cfg.SNAPSHOT_CACHE_DIR, keep=1)
+        cached = cache.load_latest()
+    loader = SnapshotLoader(
+        storage=storage,
+        full_reload_interval=cfg.DATA_FULL_RELOAD_INTERVAL,
+        counters_window=timedelta(hours=cfg.COUNTERS_UPDATING_WINDOW),
+        snapshot=cached)
+    snapshots = loader.follow(cfg.ENTITIES_CHANNEL, timeout=cfg.DATA_UPDATING_INTERVAL)
+
+snapshot: Optional[DataSnapshot] = None
+figures_cache = FiguresCache(max_size=cfg.FIGURES_CACHE_SIZE)
+
+
+def set_snapshot(data: DataSnapshot):
+    global snapshot
+    warming_up = snapshot is None
+    snapshot = data
+    if warming_up:
+        logging.info('Dashboard is ready in %.1fs after start' % (time.time() - start_time))
+    if cache is not None and data is not cached and cache.try_lock():
+        try:
+            cache.publish(data)
+        except Exception:
+            logging.exception('Failed to save snapshot')
+
+
+def serve_layout() -> html.Div:
+    data = snapshot
+    if data is None:
+        return Layout(groups=[], data_update_interval=cfg.DATA_UPDATING_INTERVAL).WarmingUp
+    layout = Layout(groups=list(data.groups_df['name'].values), data_update_interval=cfg.DATA_UPDATING_INTERVAL)
+    return html.Div([
+        layout.Navbar,
+        dbc.Row([
+            dbc.Col([
+                layout.GroupCard,
+                layout.NewsCard
+            ],
+                md=2),
+            dbc.Col(layout.GroupStatPlots,
+                    md=5,
+                    style={
+                        # 'margin-left': '1vh',
+                        'margin-top': '1vh'
+                    }
+                    ),
+            dbc.Col(layout.WordCloudCard,
+                    md=5,
+                    style={
+                        # 'margin-left': '1vh',
+                        'margin-top': '1vh'
+                    }
+                    )
         ],
-            md=2),
-        dbc.Col(layout.GroupStatPlots,
-                md=5,
-                style={
-                    # 'margin-left': '1vh',
-                    'margin-top': '1vh'
-                }
-                ),
-        dbc.Col(layout.WordCloudCard,
-                md=5,
-                style={
-                    # 'margin-left': '1vh',
-                    'margin-top': '1vh'
-                }
-                )
-    ],
-        style={"border": "0px", "margin-right": 0, "margin-left": 0, "max-width": "100%"}
-    )
-])
+            style={"border": "0px", "margin-right": 0, "margin-left": 0, "max-width": "100%"}
+        )
+    ])
+
+
+if not cfg.BACKGROUND_LOADING:
+    set_snapshot(next(snapshots))
+app.layout = serve_layout
+
+
+@app.callback(
+    Output('warmup-location', 'href'),
+    [
+        Input('warmup-interval', 'n_intervals')
+    ]
+)
+def check_warmup(_) -> str:
+    if snapshot is None:
+        raise PreventUpdate
+    return '/'
 
 
 def make_marks_time_slider(start: datetime, end: datetime):
@@ -84,20 +140,14 @@ def make_marks_time_slider(start: datetime, end: datetime):
     return ret
 
 
-def get_entities(group_name: str, entity_type: str, start_date: datetime, end_date: datetime) -> pd.DataFrame:
-    group = groups_df[groups_df['name'] == group_name].iloc[0]
-    group_entities = entities_df[
-        entities_df['post_id'].isin(
-            posts_df[posts_df['group'] == group['screen_name']]['post_id'].values
-        )
-        &
-        (entities_df['date'] <= end_date)
-        &
-        (entities_df['date'] >= start_date)
-    ]
-    if entity_type != 'ALL':
-        group_entities = group_entities[group_entities['type'] == entity_type]
-    return group_entities
+def get_entities_counts(data: DataSnapshot, group_name: str, entity_type: str,
+                        start_date: datetime, end_date: datetime) -> pd.Series:
+    group = data.get_group(group_name)
+    return data.get_entities_counts(
+        screen_name=group['screen_name'],
+        entity_type=entity_type,
+        start_date=start_date,
+        end_date=end_date)
 
 
 @app.callback(
@@ -111,8 +161,9 @@ def get_entities(group_name: str, entity_type: str, start_date: datetime, end_da
     [Input("group-select", "value")],
 )
 def populate_time_slider(group_name: str):
-    group = groups_df[groups_df['name'] == group_name].iloc[0]
-    group_posts = posts_df[posts_df['group'] == group['screen_name']]
+    data = snapshot
+    group = data.get_group(group_name)
+    group_posts = data.get_group_posts(group['screen_name'])
 
     min_date = group_posts["date"].min()
     max_date = group_posts["date"].max()
@@ -130,26 +181,22 @@ def populate_time_slider(group_name: str):
     )
 
 
-@app.callback(
-    [
-        Output("news-wordcloud", "figure"),
-        # Output("frequency_figure", "figure"),
-        Output("news-treemap", "figure"),
-        Output("no-data-alert", "style")
-    ],
-    [
-        Input("group-select", "value"),
-        Input("entity-type-drop", "value"),
-        Input("time-window-slider", "value")
-    ],
-)
 def update_wordcloud_plot(group_name: str, entity_type: str, timestamps: List[int]):
-    group_entities = get_entities(
+    data = snapshot
+    return figures_cache.get_or_create(
+        key=('wordcloud', group_name, entity_type, tuple(timestamps)),
+        version=data.version,
+        create=lambda: get_wordcloud_plots(data, group_name, entity_type, timestamps))
+
+
+def get_wordcloud_plots(data: DataSnapshot, group_name: str, entity_type: str, timestamps: List[int]):
+    entities_counts = get_entities_counts(
+        data=data,
         group_name=group_name,
         entity_type=entity_type,
         start_date=datetime.fromtimestamp(timestamps[0]),
         end_date=datetime.fromtimestamp(timestamps[1]))
-    wordcloud, frequency_figure, treemap = plots.WordCloudPlots.get_plots(group_entities)
+    wordcloud, frequency_figure, treemap = plots.WordCloudPlots.get_frequency_plots(entities_counts)
     alert_style = {"display": "none"}
     if (wordcloud == {}) or (frequency_figure == {}) or (treemap == {}):
         alert_style = {"display": "block"}
@@ -157,30 +204,166 @@ def update_wordcloud_plot(group_name: str, entity_type: str, timestamps: List[in
     # return wordcloud, frequency_figure, treemap, alert_style
 
 
-@app.callback(
-    [
-        Output("group-views-plot", "figure"),
-        Output("group-comments-plot", "figure"),
-        Output("group-likes-plot", "figure"),
-        Output("group-reposts-plot", "figure")
-    ],
-    [
-        Input("group-select", "value")
-    ]
-)
-def update_group_stat_plots(group_name: str):
+def update_wordcloud_store(group_name: str, entity_type: str) -> Optional[dict]:
     if group_name is None:
-        return {}, {}, {}, {}
-    group = groups_df[groups_df['name'] == group_name].iloc[0]
-    group_posts = posts_df[posts_df['group'] == group['screen_name']]
+        return None
+    data = snapshot
+    return figures_cache.get_or_create(
+        key=('wordcloud_data', group_name, entity_type),
+        version=data.version,
+        create=lambda: get_wordcloud_data(data, group_name, entity_type))
+
+
+def get_wordcloud_data(data: DataSnapshot, group_name: str, entity_type: str) -> dict:
+    group = data.get_group(group_name)
+    entities, days, counts = data.get_entities_matrix(group['screen_name'], entity_type, cfg.WORDCLOUD_TOP_K)
+    return plots.WordCloudPlots.get_counts_data(entities, days, counts)
+
+
+if cfg.CLIENTSIDE_WORDCLOUD:
+    app.callback(
+        Output("wordcloud-store", "data"),
+        [
+            Input("group-select", "value"),
+            Input("entity-type-drop", "value")
+        ]
+    )(update_wordcloud_store)
+    app.clientside_callback(
+        plots.WordCloudPlots.clientside_function,
+        [
+            Output("news-wordcloud", "figure"),
+            Output("news-treemap", "figure"),
+            Output("no-data-alert", "style")
+        ],
+        [
+            Input("wordcloud-store", "data"),
+            Input("time-window-slider", "value")
+        ]
+    )
+else:
+    app.callback(
+        [
+            Output("news-wordcloud", "figure"),
+            # Output("frequency_figure", "figure"),
+            Output("news-treemap", "figure"),
+            Output("no-data-alert", "style")
+        ],
+        [
+            Input("group-select", "value"),
+            Input("entity-type-drop", "value"),
+            Input("time-window-slider", "value")
+        ],
+    )(update_wordcloud_plot)
+
+
+def get_relayout_window(data: DataSnapshot, group_name: str,
+                        relayout_data: Optional[dict]) -> Optional[Tuple[datetime, datetime]]:
+    """
+    Returns x-axis range set by zoom or pan, or whole posts range on autorange.
+    Returns None if x-axis range was not changed
+
+    """
+    if not relayout_data:
+        return None
+    if 'xaxis.range[0]' in relayout_data and 'xaxis.range[1]' in relayout_data:
+        return pd.Timestamp(relayout_data['xaxis.range[0]']), pd.Timestamp(relayout_data['xaxis.range[1]'])
+    if 'xaxis.range' in relayout_data:
+        return pd.Timestamp(relayout_data['xaxis.range'][0]), pd.Timestamp(relayout_data['xaxis.range'][1])
+    if relayout_data.get('xaxis.autorange'):
+        group = data.get_group(group_name)
+        group_posts = data.get_group_posts(group['screen_name'])
+        return group_posts['date'].min(), group_posts['date'].max()
+    return None
+
+
+def get_triggered_window(data: DataSnapshot, group_name: str, graph_ids: List[str],
+                         relayouts: List[Optional[dict]]) -> Optional[Tuple[datetime, datetime]]:
+    """
+    Returns x-axis range changed on one of graphs or None if callback was triggered by group select.
+    Prevents update for other relayout events
+
+    """
+    triggers = [trigger['prop_id'] for trigger in dash.callback_context.triggered]
+    for graph_id, relayout_data in zip(graph_ids, relayouts):
+        if f'{graph_id}.relayoutData' in triggers:
+            window = get_relayout_window(data, group_name, relayout_data)
+            if window is None:
+                raise PreventUpdate
+            return window
+    return None
+
+
+def register_group_stat_plot(graph_id: str, get_plot: Callable[..., Any]):
+    """
+    Group select draws plot for last day, zoom and pan fetch posts of new x-axis range.
+    Overview outside of range is downsampled
+
+    """
+    @app.callback(
+        Output(graph_id, "figure"),
+        [
+            Input("group-select", "value"),
+            Input(graph_id, "relayoutData")
+        ]
+    )
+    def update_group_stat_plot(group_name: str, relayout_data: Optional[dict]):
+        if group_name is None:
+            return {}
+        data = snapshot
+        window = get_triggered_window(data, group_name, [graph_id], [relayout_data])
+        return figures_cache.get_or_create(
+            key=('group_stat', graph_id, group_name, window),
+            version=data.version,
+            create=lambda: get_group_stat_plot(data, group_name, get_plot, window))
+
+
+def get_group_stat_plot(data: DataSnapshot, group_name: str, get_plot: Callable[..., Any],
+                        window: Optional[Tuple[datetime, datetime]]):
+    group = data.get_group(group_name)
+    group_posts = data.get_group_posts(group['screen_name'])
+    if window is None:
+        return get_plot(group_posts)
+    return get_plot(group_posts, start=window[0], end=window[1])
+
+
+def register_group_stats_store(graph_ids: List[str]):
+    """
+    Sends posts of all four plots in one store, plots are built from it by clientside callback.
+    Zoom or pan on any plot fetches posts of new x-axis range for all of them
+
+    """
+    @app.callback(
+        Output("group-stats-store", "data"),
+        [Input("group-select", "value")] + [Input(graph_id, "relayoutData") for graph_id in graph_ids]
+    )
+    def update_group_stats_store(group_name: str, *relayouts: Optional[dict]):
+        if group_name is None:
+            return None
+        data = snapshot
+        window = get_triggered_window(data, group_name, graph_ids, list(relayouts))
+        return figures_cache.get_or_create(
+            key=('group_stats_data', group_name, window),
+            version=data.version,
+            create=lambda: get_group_stat_plot(data, group_name, plots.LineCharts.get_data, window))
+
+    app.clientside_callback(
+        plots.LineCharts.figures_function,
+        [Output(graph_id, "figure") for graph_id in graph_ids],
+        [Input("group-stats-store", "data")]
+    )
 
-    views_fig = plots.LineCharts.views(group_posts)
-    comments_fig = plots.LineCharts.comments(group_posts)
-    likes_fig = plots.LineCharts.likes(group_posts)
-    reposts_fig = plots.LineCharts.reposts(group_posts)
 
-    # return views_fig, comments_fig
-    return views_fig, comments_fig, likes_fig, reposts_fig
+group_stat_plots = {
+    "group-views-plot": plots.LineCharts.views,
+    "group-comments-plot": plots.LineCharts.comments,
+    "group-likes-plot": plots.LineCharts.likes,
+    "group-reposts-plot": plots.LineCharts.reposts
+}
+if cfg.CLIENTSIDE_STAT_PLOTS:
+    register_group_stats_store(list(group_stat_plots))
+else:
+    for stat_graph_id, get_stat_plot in group_stat_plots.items():
+        register_group_stat_plot(stat_graph_id, get_stat_plot)
 
 
 @app.callback(
@@ -192,18 +375,17 @@ def update_group_stat_plots(group_name: str):
 def groups_info_update(group_name: str) -> List[Any]:
     if group_name is None:
         return []
-    group = groups_df[groups_df['name'] == group_name].iloc[0]
-    group_posts = posts_df[posts_df['group'] == group['screen_name']]
+    group = snapshot.get_group(group_name)
     children = [
         html.A(f'Число подписчиков: {group["members_count"]}'),
         html.Br(),
-        html.A(f'В среднем просмотров: {int(group_posts["views_count"].mean())}'),
+        html.A(f'В среднем просмотров: {int(group["views_mean"])}'),
         html.Br(),
-        html.A(f'В среднем лайков: {int(group_posts["likes_count"].mean())}'),
+        html.A(f'В среднем лайков: {int(group["likes_mean"])}'),
         html.Br(),
-        html.A(f'В среднем комментариев: {int(group_posts["comments_count"].mean())}'),
+        html.A(f'В среднем комментариев: {int(group["comments_mean"])}'),
         html.Br(),
-        html.A(f'В среднем репостов: {int(group_posts["reposts_count"].mean())}')
+        html.A(f'В среднем репостов: {int(group["reposts_mean"])}')
     ]
     return children
 
@@ -215,40 +397,19 @@ def groups_info_update(group_name: str) -> List[Any]:
     ]
 )
 def update_news(_) -> List[Any]:
-    return plots.NewsTable.update_news(posts_df, groups_df)
-
-
-@asyncio.coroutine
-async def update_data():
-    global storage, extractor, posts, groups, entities, posts_df, groups_df, entities_df
-    while True:
-        await asyncio.sleep(cfg.DATA_UPDATING_INTERVAL)
-
-        unprocessed_posts = storage.get_unprocessed_posts()
-        logging.info('Loaded %d new posts' % len(unprocessed_posts))
-        new_entities = []
-        if unprocessed_posts:
-            new_entities = extractor.get_entities(unprocessed_posts)
-        if new_entities:
-            storage.add_entities(new_entities)
-        logging.info('Add %d new entities' % len(new_entities))
-
-        posts = storage.get_posts()
-        groups = storage.get_groups()
-        entities = storage.get_entities()
-
-        posts_df = TextProcessor.parse_posts(posts)
-        groups_df = TextProcessor.parse_groups(groups)
-        entities_df = TextProcessor.parse_entities(entities)
+    data = snapshot
+    return plots.NewsTable.update_news(data.news_feed)
 
-        logging.info('Update posts and entities')
 
+def update_data():
+    """
+    Publishes snapshots built by loader in this process, or ones
+    mapped from SNAPSHOT_DIR when data is loaded by separate process
 
-def update_data_loop(update_loop):
-    asyncio.set_event_loop(update_loop)
-    update_loop.run_until_complete(update_data())
+    """
+    for data in snapshots:
+        set_snapshot(data)
 
 
-loop = asyncio.get_event_loop()
-t = threading.Thread(target=update_data_loop, args=(loop,))
+t = threading.Thread(target=update_data)
 t.start()
@@ -5,5 +5,31 @@ PG_PASS = os.getenv('PG_PASS', 'password')
 PG_HOST = os.getenv('PG_HOST', '172.17.0.2')
 PG_PORT = os.getenv('PG_PORT', 5432)
 PG_NAME = os.getenv('PG_NAME', 'vknews')
+PG_ITERSIZE = int(os.getenv('PG_ITERSIZE', '10000'))
+PG_COPY_CHUNK_SIZE = int(os.getenv('PG_COPY_CHUNK_SIZE', '50000'))
+PG_POOL_MIN = int(os.getenv('PG_POOL_MIN', '1'))
+PG_POOL_MAX = int(os.getenv('PG_POOL_MAX', '4'))
+PG_RETRIES = int(os.getenv('PG_RETRIES', '5'))
+PG_BACKOFF = float(os.getenv('PG_BACKOFF', '1.0'))  # seconds
 DATA_UPDATING_INTERVAL = int(os.getenv('DATA_UPDATING_INTERVAL', '600'))  # 10 minutes
 DEBUG = bool(os.getenv('DEBUG', False))
+BACKGROUND_LOADING = bool(int(os.getenv('BACKGROUND_LOADING', '1')))  # serve warming up page while data loads
+DATA_FULL_RELOAD_INTERVAL = int(os.getenv('DATA_FULL_RELOAD_INTERVAL', '21600'))  # 6 hours
+COUNTERS_UPDATING_WINDOW = int(os.getenv('COUNTERS_UPDATING_WINDOW', '48'))  # hours before newest rows re-read by refresh
+NER_WORKERS = int(os.getenv('NER_WORKERS', '1'))
+NER_BATCH_SIZE = int(os.getenv('NER_BATCH_SIZE', '100'))
+NER_PROFILE = os.getenv('NER_PROFILE', 'fast')  # fast or full
+NER_CACHE_PATH = os.getenv('NER_CACHE_PATH', 'ner_cache.sqlite3')  # empty string disables cache
+NER_CACHE_SIZE = int(os.getenv('NER_CACHE_SIZE', '100000'))
+NER_CLAIM_SIZE = int(os.getenv('NER_CLAIM_SIZE', '1000'))  # posts processed in one transaction
+NER_MAX_ATTEMPTS = int(os.getenv('NER_MAX_ATTEMPTS', '3'))  # failed post is moved to failed_posts after this many attempts
+FIGURES_CACHE_SIZE = int(os.getenv('FIGURES_CACHE_SIZE', '256'))
+CLIENTSIDE_WORDCLOUD = bool(int(os.getenv('CLIENTSIDE_WORDCLOUD', '0')))  # filter word cloud by time slider in browser
+WORDCLOUD_TOP_K = int(os.getenv('WORDCLOUD_TOP_K', '200'))  # entities sent to browser in clientside mode
+CLIENTSIDE_STAT_PLOTS = bool(int(os.getenv('CLIENTSIDE_STAT_PLOTS', '1')))  # build stat plots in browser from one data store
+NER_PROCESSING_INTERVAL = int(os.getenv('NER_PROCESSING_INTERVAL', '60'))  # seconds
+ENTITIES_CHANNEL = os.getenv('ENTITIES_CHANNEL', 'entities_added')
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR', '')  # shared by loader and web workers, empty string loads data in each worker
+SNAPSHOT_KEEP = int(os.getenv('SNAPSHOT_KEEP', '2'))  # published versions kept on disk
+SNAPSHOT_POLL_INTERVAL = float(os.getenv('SNAPSHOT_POLL_INTERVAL', '5'))  # seconds
+SNAPSHOT_CACHE_DIR = os.getenv('SNAPSHOT_CACHE_DIR', 'snapshot_cache')  # warm restart without SNAPSHOT_DIR, empty string disables
@@ -0,0 +1,73 @@
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import List, Dict, Optional
+
+
+class EntitiesCache:
+    """
+    On-disk LRU cache of extracted entities keyed by hash of normalized text
+    and NER pipeline version
+
+    """
+
+    path: str
+    max_size: int
+    version: str
+    conn: sqlite3.Connection
+    lock: threading.Lock
+    eviction_interval: int
+    whitespace = re.compile(r'\s+')
+
+    def __init__(self, path: str, max_size: int, version: str):
+        self.path = path
+        self.max_size = max_size
+        self.version = version
+        self.eviction_interval = max(1, min(1000, max_size // 10))
+        self.lock = threading.Lock()
+        self.puts = 0
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS entities (
+                    key TEXT PRIMARY KEY,
+                    entities TEXT NOT NULL,
+                    used_at REAL NOT NULL
+                )''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS entities_used_at_idx ON entities(used_at)')
+
+    def get_key(self, text: str) -> str:
+        normalized_text = self.whitespace.sub(' ', text).strip()
+        return hashlib.sha1(f'{self.version}\n{normalized_text}'.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[List[Dict[str, str]]]:
+        with self.lock, self.conn:
+            row = self.conn.execute('SELECT entities FROM entities WHERE key = ?', [key]).fetchone()
+            if row is None:
+                return None
+            self.conn.execute('UPDATE entities SET used_at = ? WHERE key = ?', [time.time(), key])
+        return json.loads(row[0])
+
+    def put(self, key: str, entities: List[Dict[str, str]]):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO entities(key, entities, used_at) VALUES (?, ?, ?)',
+                [key, json.dumps(entities, ensure_ascii=False), time.time()])
+            self.puts += 1
+            if self.puts % self.eviction_interval == 0:
+                self.evict()
+
+    def evict(self):
+        count = self.conn.execute('SELECT COUNT(*) FROM entities').fetchone()[0]
+        if count > self.max_size:
+            self.conn.execute('''
+                DELETE FROM entities WHERE key IN (
+                    SELECT key FROM entities ORDER BY used_at LIMIT ?
+                )''', [count - self.max_size])
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -1,5 +1,8 @@
-import datetime
-from typing import List, Dict
+import time
+import logging
+import multiprocessing
+import multiprocessing.pool
+from typing import List, Dict, Optional
 
 from natasha import (
     Segmenter,
@@ -12,14 +15,27 @@ from natasha import (
     NamesExtractor,
 
     PER,
+    ORG,
 
     Doc
 )
+from natasha.doc import sent_words, inject_morph, inject_syntax, offset_syntax
 
-from src.preprocessing import TextProcessor
+from src.entities_cache import EntitiesCache
+
+FULL_PROFILE = 'full'
+FAST_PROFILE = 'fast'
+PIPELINE_VERSION = 'natasha-news-1'
 
 
 class EntitiesExtractor:
+    """
+    Natasha models are loaded on first extraction, so creating extractor is cheap
+    and pool workers load their own models only once
+
+    """
+
+    models_loaded: bool
     morph_vocab: MorphVocab
     emb: NewsEmbedding
     segmenter: Segmenter
@@ -27,8 +43,31 @@ class EntitiesExtractor:
     morph_tagger: NewsMorphTagger
     syntax_parser: NewsSyntaxParser
     names_extractor: NamesExtractor
+    workers: int
+    batch_size: int
+    profile: str
+    cache_path: Optional[str]
+    cache_size: int
+    cache: Optional[EntitiesCache]
+    pool: Optional[multiprocessing.pool.Pool]
+
+    def __init__(self, workers: int = 1, batch_size: int = 100, profile: str = FAST_PROFILE,
+                 cache_path: Optional[str] = None, cache_size: int = 100000):
+        if profile not in (FULL_PROFILE, FAST_PROFILE):
+            raise ValueError(f'Unknown NER pipeline profile: {profile}')
+        self.workers = workers
+        self.profile = profile
+        self.batch_size = batch_size
+        self.cache_path = cache_path
+        self.cache_size = cache_size
+        self.cache = EntitiesCache(cache_path, cache_size, f'{PIPELINE_VERSION}-{profile}') if cache_path else None
+        self.pool = None
+        self.models_loaded = False
 
-    def __init__(self):
+    def load_models(self):
+        if self.models_loaded:
+            return
+        start = time.time()
         self.morph_vocab = MorphVocab()
         self.emb = NewsEmbedding()
         self.segmenter = Segmenter()
@@ -36,8 +75,13 @@ class EntitiesExtractor:
         self.morph_tagger = NewsMorphTagger(self.emb)
         self.syntax_parser = NewsSyntaxParser(self.emb)
         self.names_extractor = NamesExtractor(self.morph_vocab)
+        self.models_loaded = True
+        logging.info('Loaded NER models in %.1fs' % (time.time() - start))
 
     def get_doc(self, text: str) -> Doc:
+        self.load_models()
+        if self.profile == FAST_PROFILE:
+            return self.get_fast_doc(text)
         doc = Doc(text)
 
         doc.segment(self.segmenter)
@@ -47,7 +91,49 @@ class EntitiesExtractor:
         doc.tag_ner(self.ner_tagger)
         return doc
 
+    def get_fast_doc(self, text: str) -> Doc:
+        """
+        Runs NER first, then tags morphology only for sentences containing spans
+        (needed by span normalization) and parses syntax only for sentences
+        containing ORG spans (the only type normalized by syntax)
+
+        """
+        doc = Doc(text)
+
+        doc.segment(self.segmenter)
+        doc.tag_ner(self.ner_tagger)
+
+        morph_sents = []
+        syntax_sents = []
+        for sent_id, sent in enumerate(doc.sents, 1):
+            spans = [span for span in doc.spans if span.start < sent.stop and span.stop > sent.start]
+            if spans:
+                morph_sents.append((sent_id, sent))
+            if any(span.type == ORG for span in spans):
+                syntax_sents.append((sent_id, sent))
+
+        if morph_sents:
+            markups = self.morph_tagger.map([sent_words(sent) for _, sent in morph_sents])
+            for (_, sent), markup in zip(morph_sents, markups):
+                inject_morph(sent.tokens, markup.tokens)
+        if syntax_sents:
+            markups = self.syntax_parser.map([sent_words(sent) for _, sent in syntax_sents])
+            for (sent_id, sent), markup in zip(syntax_sents, markups):
+                inject_syntax(sent.tokens, markup.tokens)
+                offset_syntax(sent_id, sent.tokens)
+        return doc
+
     def extract_entities(self, text: str) -> List[Dict[str, str]]:
+        if self.cache is None:
+            return self.find_entities(text)
+        key = self.cache.get_key(text)
+        entities = self.cache.get(key)
+        if entities is None:
+            entities = self.find_entities(text)
+            self.cache.put(key, entities)
+        return entities
+
+    def find_entities(self, text: str) -> List[Dict[str, str]]:
         doc = self.get_doc(text)
         for span in doc.spans:
             span.normalize(self.morph_vocab)
@@ -73,15 +159,61 @@ class EntitiesExtractor:
             })
         return entities
 
+    def get_post_entities(self, post: tuple) -> List[tuple]:
+        post_id, date, title, text = post
+        post_entities = {}
+        for entity in self.extract_entities(title):
+            post_entities[entity['text']] = entity['type']
+        for entity in self.extract_entities(text):
+            post_entities[entity['text']] = entity['type']
+        return [
+            (post_id, entity_type, date, entity)
+            for entity, entity_type in post_entities.items()
+        ]
+
+    def extract_batch(self, posts: List[tuple]) -> List[tuple]:
+        entities = []
+        for post in posts:
+            entities.extend(self.get_post_entities(post))
+        return entities
+
+    def get_pool(self) -> multiprocessing.pool.Pool:
+        if self.pool is None:
+            context = multiprocessing.get_context('spawn')
+            self.pool = context.Pool(processes=self.workers, initializer=init_worker,
+                                     initargs=(self.profile, self.cache_path, self.cache_size))
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
     def get_entities(self, posts_list: List[tuple]) -> List[tuple]:
+        start = time.time()
+        posts = [(post[0], post[2], post[3], post[4]) for post in posts_list]
+        batches = [posts[i:i + self.batch_size] for i in range(0, len(posts), self.batch_size)]
+        if self.workers > 1 and len(batches) > 1:
+            results = self.get_pool().imap(extract_batch, batches)
+        else:
+            results = map(self.extract_batch, batches)
         entities = []
-        posts_df = TextProcessor.parse_posts(posts_list)
-        for index, post in posts_df.iterrows():
-            post_entities = {}
-            for entity in self.extract_entities(post['title']):
-                post_entities[entity['text']] = entity['type']
-            for entity in self.extract_entities(post['text']):
-                post_entities[entity['text']] = entity['type']
-            for entity, entity_type in post_entities.items():
-                entities.append((post['post_id'], entity_type, post['date'] - datetime.timedelta(hours=3), entity))
+        for batch_entities in results:
+            entities.extend(batch_entities)
+        elapsed = time.time() - start
+        logging.info('Processed %d posts in %.1fs (%.1f posts/sec)' % (
+            len(posts), elapsed, len(posts) / elapsed if elapsed else 0))
         return entities
+
+
+worker_extractor: Optional[EntitiesExtractor] = None
+
+
+def init_worker(profile: str, cache_path: Optional[str], cache_size: int):
+    global worker_extractor
+    worker_extractor = EntitiesExtractor(profile=profile, cache_path=cache_path, cache_size=cache_size)
+
+
+def extract_batch(posts: List[tuple]) -> List[tuple]:
+    return worker_extractor.extract_batch(posts)
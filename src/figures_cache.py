@@ -0,0 +1,40 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class FiguresCache:
+    """
+    Thread-safe LRU cache of callbacks results bound to data snapshot version.
+    All entries are dropped once result for newer version is requested.
+    Results for older versions, requested by callbacks still holding previous
+    snapshot, are built without touching the cache
+
+    """
+
+    max_size: int
+    version: Optional[int]
+    items: OrderedDict
+    lock: threading.Lock
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.version = None
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_or_create(self, key: Hashable, version: int, create: Callable[[], Any]) -> Any:
+        with self.lock:
+            if self.version is None or version > self.version:
+                self.items.clear()
+                self.version = version
+            elif version == self.version and key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+        value = create()
+        with self.lock:
+            if version == self.version:
+                self.items[key] = value
+                while len(self.items) > self.max_size:
+                    self.items.popitem(last=False)
+        return value
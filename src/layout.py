@@ -36,6 +36,22 @@ class Layout:
             sticky="top",
         )
 
+    @property
+    def WarmingUp(self) -> html.Div:
+        return html.Div([
+            self.Navbar,
+            dbc.Alert(
+                "Загрузка данных, страница обновится автоматически",
+                color="info",
+                style={'margin': '1vh'}
+            ),
+            dcc.Location(id='warmup-location', refresh=True),
+            dcc.Interval(
+                id='warmup-interval',
+                interval=3000,  # in milliseconds
+                n_intervals=0)
+        ])
+
     @property
     def GroupCard(self) -> dbc.Card:
         return dbc.Card([
@@ -137,7 +153,8 @@ class Layout:
                                 ],
                             ),
                         ],
-                    )
+                    ),
+                    dcc.Store(id="group-stats-store")
                 ],
                 style={'color': 'black'}
             ),
@@ -215,7 +232,8 @@ class Layout:
                                 # md=8,
                             ),
                         ]
-                    )
+                    ),
+                    dcc.Store(id="wordcloud-store")
                 ],
                 style={'color': 'black'}
             ),
@@ -0,0 +1,51 @@
+import logging
+from datetime import timedelta
+
+from src import config as cfg
+from src import migrations
+from src.postgres import Storage
+from src.snapshot import SnapshotLoader
+from src.snapshot_store import SnapshotStore
+
+
+def main():
+    """
+    Builds data snapshot once for all dashboard workers and publishes it to SNAPSHOT_DIR.
+    Starts from latest published snapshot, so restart loads only new rows
+
+    """
+    logging.basicConfig(level=logging.INFO)
+    store = SnapshotStore(cfg.SNAPSHOT_DIR, keep=cfg.SNAPSHOT_KEEP)
+    if not store.try_lock():
+        logging.error('Snapshots in %s are published by other loader' % cfg.SNAPSHOT_DIR)
+        return
+    storage = Storage.connect(
+        dbname=cfg.PG_NAME,
+        user=cfg.PG_USER,
+        password=cfg.PG_PASS,
+        host=cfg.PG_HOST,
+        port=cfg.PG_PORT,
+        itersize=cfg.PG_ITERSIZE,
+        copy_chunk_size=cfg.PG_COPY_CHUNK_SIZE,
+        minconn=cfg.PG_POOL_MIN,
+        maxconn=cfg.PG_POOL_MAX,
+        retries=cfg.PG_RETRIES,
+        backoff=cfg.PG_BACKOFF)
+    migrations.migrate(storage)
+    published = store.load_latest()
+    loader = SnapshotLoader(
+        storage=storage,
+        full_reload_interval=cfg.DATA_FULL_RELOAD_INTERVAL,
+        counters_window=timedelta(hours=cfg.COUNTERS_UPDATING_WINDOW),
+        snapshot=published)
+    for snapshot in loader.follow(cfg.ENTITIES_CHANNEL, timeout=cfg.DATA_UPDATING_INTERVAL):
+        if snapshot is published:
+            continue
+        try:
+            store.publish(snapshot)
+        except Exception:
+            logging.exception('Failed to publish snapshot')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import logging
+from typing import List, Tuple
+
+import psycopg2
+
+from src.postgres import PostgresStorage
+
+MIGRATIONS: List[Tuple[int, str, str]] = [
+    (1, 'posts and entities indexes', '''
+        CREATE INDEX IF NOT EXISTS entities_date_idx ON entities(date);
+        CREATE INDEX IF NOT EXISTS entities_post_id_idx ON entities(post_id);
+        CREATE INDEX IF NOT EXISTS posts_date_idx ON posts(date);
+        CREATE INDEX IF NOT EXISTS posts_group_date_idx ON posts(group_screen_name, date)'''),
+
+    (2, 'unique post entities', '''
+        DELETE FROM entities e
+        USING entities d
+        WHERE e.post_id = d.post_id AND e.date = d.date AND e.entity = d.entity AND e.ctid > d.ctid;
+        CREATE UNIQUE INDEX IF NOT EXISTS entities_post_entity_idx ON entities(post_id, date, entity)'''),
+
+    (3, 'unprocessed posts queue', '''
+        CREATE TABLE IF NOT EXISTS unprocessed_posts (
+            post_id INTEGER NOT NULL,
+            group_screen_name TEXT NOT NULL,
+            date TIMESTAMP NOT NULL,
+            PRIMARY KEY (group_screen_name, post_id)
+        );
+        CREATE INDEX IF NOT EXISTS unprocessed_posts_date_idx ON unprocessed_posts(date);
+
+        CREATE OR REPLACE FUNCTION enqueue_unprocessed_post() RETURNS TRIGGER AS $$
+        BEGIN
+            INSERT INTO unprocessed_posts(post_id, group_screen_name, date)
+            VALUES (NEW.post_id, NEW.group_screen_name, NEW.date)
+            ON CONFLICT DO NOTHING;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS enqueue_unprocessed_post ON posts;
+        CREATE TRIGGER enqueue_unprocessed_post AFTER INSERT ON posts
+            FOR EACH ROW EXECUTE PROCEDURE enqueue_unprocessed_post();
+
+        INSERT INTO unprocessed_posts(post_id, group_screen_name, date)
+        SELECT p.post_id, p.group_screen_name, p.date
+        FROM posts p
+        WHERE NOT EXISTS (
+            SELECT 1 FROM entities e WHERE e.post_id = p.post_id AND e.date = p.date
+        )
+        ON CONFLICT DO NOTHING'''),
+
+    (4, 'entities daily rollup', '''
+        CREATE TABLE IF NOT EXISTS entities_daily (
+            group_screen_name TEXT NOT NULL,
+            type TEXT NOT NULL,
+            day DATE NOT NULL,
+            entity TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (group_screen_name, type, day, entity)
+        );
+        CREATE INDEX IF NOT EXISTS entities_daily_day_idx ON entities_daily(day);
+
+        INSERT INTO entities_daily(group_screen_name, type, day, entity, count)
+        SELECT p.group_screen_name, e.type, e.date::date, e.entity, COUNT(*)
+        FROM entities e
+        JOIN posts p ON p.post_id = e.post_id AND p.date = e.date
+        GROUP BY p.group_screen_name, e.type, e.date::date, e.entity
+        ON CONFLICT DO NOTHING'''),
+
+    (5, 'posts daily stats', '''
+        CREATE MATERIALIZED VIEW IF NOT EXISTS posts_daily_stats AS
+        SELECT group_screen_name, date::date AS day, COUNT(*) AS posts_count,
+               SUM(likes_count) AS likes_sum, SUM(views_count) AS views_sum,
+               SUM(comments_count) AS comments_sum, SUM(reposts_count) AS reposts_sum
+        FROM posts
+        GROUP BY group_screen_name, date::date;
+        CREATE UNIQUE INDEX IF NOT EXISTS posts_daily_stats_group_day_idx
+            ON posts_daily_stats(group_screen_name, day)'''),
+
+    (6, 'failed posts', '''
+        ALTER TABLE unprocessed_posts ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+        CREATE INDEX IF NOT EXISTS unprocessed_posts_attempts_date_idx ON unprocessed_posts(attempts, date);
+        CREATE TABLE IF NOT EXISTS failed_posts (
+            post_id INTEGER NOT NULL,
+            group_screen_name TEXT NOT NULL,
+            date TIMESTAMP NOT NULL,
+            attempts INTEGER NOT NULL,
+            error TEXT,
+            failed_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (group_screen_name, post_id)
+        )'''),
+]
+
+
+def migrate(storage: PostgresStorage) -> List[int]:
+    """
+    Applies pending migrations in one transaction and records them in schema_migrations.
+    Concurrent callers (dashboard and worker) are serialized by advisory lock.
+    Every migration is idempotent, so objects created before versioning are kept
+
+    """
+    def apply(cursor: psycopg2.extensions.cursor) -> List[int]:
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'))")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT now()
+            )''')
+        cursor.execute('SELECT version FROM schema_migrations')
+        applied_versions = {row[0] for row in cursor.fetchall()}
+        applied = []
+        for version, name, query in MIGRATIONS:
+            if version in applied_versions:
+                continue
+            cursor.execute(query)
+            cursor.execute('INSERT INTO schema_migrations(version, name) VALUES (%s, %s)', [version, name])
+            applied.append(version)
+        return applied
+
+    applied = storage.run(apply)
+    for version, name, _ in MIGRATIONS:
+        if version in applied:
+            logging.info('Applied migration %d: %s' % (version, name))
+    return applied
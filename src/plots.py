@@ -1,19 +1,105 @@
 import datetime
-from typing import List, Any
+from typing import List, Dict, Any, Optional, Tuple
 from collections import Counter
 
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
 import plotly.graph_objs as go
+import numpy as np
 import pandas as pd
-from wordcloud import WordCloud
+
+from src.preprocessing import TextProcessor
+from src.wordcloud_layout import WordCloudLayout
 
 
 class LineCharts:
+    overview_points = 500
+    max_points = 2000
+
+    y_columns = ['views_count', 'comments_count', 'likes_count', 'reposts_count']
+    figures_function = '''
+        function(data) {
+            if (!data) {
+                return [{}, {}, {}, {}];
+            }
+            return ['views_count', 'comments_count', 'likes_count', 'reposts_count'].map(function(column) {
+                return {
+                    data: [{
+                        type: 'scatter',
+                        x: data.date,
+                        y: data[column],
+                        text: data.hovertext,
+                        textfont: {color: 'white'},
+                        hovertemplate: '%{text}<br><extra></extra>'
+                    }],
+                    layout: {
+                        paper_bgcolor: 'rgba(0,0,0,0)',
+                        plot_bgcolor: 'rgba(0,0,0,0)',
+                        xaxis: {range: data.range}
+                    }
+                };
+            });
+        }'''
+
+    @staticmethod
+    def downsample(data: pd.DataFrame, y_columns: List[str], points: int) -> pd.DataFrame:
+        """
+        Splits date range into points buckets and keeps posts with max value
+        of any of y_columns in each bucket, so peaks stay visible.
+        Data must be sorted by date
+
+        """
+        if len(data) <= points:
+            return data
+        dates = data['date'].values.astype(np.int64)
+        # in float, as nanoseconds span multiplied by points overflows int64
+        buckets = np.minimum(((dates - dates[0]) / (dates[-1] - dates[0] + 1) * points).astype(np.int64), points - 1)
+        positions = []
+        for y_data in y_columns:
+            order = np.lexsort((-data[y_data].values, buckets))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = buckets[order[1:]] != buckets[order[:-1]]
+            positions.append(order[first])
+        return data.iloc[np.unique(np.concatenate(positions))]
 
     @staticmethod
-    def get_plot(data: pd.DataFrame, y_data: str) -> go.Figure:
+    def get_window(start: Optional[datetime.datetime] = None,
+                   end: Optional[datetime.datetime] = None) -> Tuple[datetime.datetime, datetime.datetime]:
+        if start is None or end is None:
+            return datetime.datetime.now() - datetime.timedelta(days=1), datetime.datetime.now()
+        return start, end
+
+    @classmethod
+    def select_window(cls, data: pd.DataFrame, y_columns: List[str],
+                      start: datetime.datetime, end: datetime.datetime) -> pd.DataFrame:
+        """
+        Keeps posts inside window in full detail and downsampled overview of posts outside of it.
+        Points budget is shared by y_columns, so result size does not grow with columns count
+
+        """
+        overview_points = max(1, cls.overview_points // len(y_columns))
+        max_points = max(1, cls.max_points // len(y_columns))
+        data = data.sort_values(by=['date'], kind='mergesort')
+        dates = data['date'].values
+        window_start = dates.searchsorted(np.datetime64(start), side='left')
+        window_end = dates.searchsorted(np.datetime64(end), side='right')
+        return pd.concat([
+            cls.downsample(data.iloc[:window_start], y_columns, overview_points),
+            cls.downsample(data.iloc[window_start:window_end], y_columns, max_points),
+            cls.downsample(data.iloc[window_end:], y_columns, overview_points)
+        ])
+
+    @classmethod
+    def get_plot(cls, data: pd.DataFrame, y_data: str,
+                 start: Optional[datetime.datetime] = None, end: Optional[datetime.datetime] = None) -> go.Figure:
+        """
+        Sends posts inside visible window in full detail and downsampled overview
+        of posts outside of it. Window is last day unless start and end are given
+
+        """
+        start, end = cls.get_window(start, end)
+        data = cls.select_window(data, [y_data], start, end)
         fig = go.Figure(
             layout=dict(
                 paper_bgcolor='rgba(0,0,0,0)',
@@ -27,26 +113,48 @@ class LineCharts:
                               '<extra></extra>'
             )]
         )
-        fig.layout.xaxis.range = pd.date_range(
-            start=datetime.datetime.now() - datetime.timedelta(days=1),
-            end=datetime.datetime.now())
+        fig.layout.xaxis.range = [start, end]
         return fig
 
+    @classmethod
+    def get_data(cls, data: pd.DataFrame,
+                 start: Optional[datetime.datetime] = None, end: Optional[datetime.datetime] = None) -> dict:
+        """
+        Same posts as in get_plot for all four counters at once, so dates and
+        hovertext are sent once. Figures are built from it by figures_function
+        in browser
+
+        """
+        start, end = cls.get_window(start, end)
+        data = cls.select_window(data, cls.y_columns, start, end)
+        stats_data = {
+            'date': TextProcessor.format_dates(data['date']).values.tolist(),
+            'hovertext': data['hovertext'].values.tolist(),
+            'range': [str(start), str(end)]
+        }
+        for y_data in cls.y_columns:
+            stats_data[y_data] = data[y_data].values.tolist()
+        return stats_data
+
     @staticmethod
-    def views(data: pd.DataFrame) -> go.Figure:
-        return LineCharts.get_plot(data=data, y_data='views_count')
+    def views(data: pd.DataFrame, start: Optional[datetime.datetime] = None,
+              end: Optional[datetime.datetime] = None) -> go.Figure:
+        return LineCharts.get_plot(data=data, y_data='views_count', start=start, end=end)
 
     @staticmethod
-    def likes(data: pd.DataFrame) -> go.Figure:
-        return LineCharts.get_plot(data=data, y_data='likes_count')
+    def likes(data: pd.DataFrame, start: Optional[datetime.datetime] = None,
+              end: Optional[datetime.datetime] = None) -> go.Figure:
+        return LineCharts.get_plot(data=data, y_data='likes_count', start=start, end=end)
 
     @staticmethod
-    def comments(data: pd.DataFrame) -> go.Figure:
-        return LineCharts.get_plot(data=data, y_data='comments_count')
+    def comments(data: pd.DataFrame, start: Optional[datetime.datetime] = None,
+              end: Optional[datetime.datetime] = None) -> go.Figure:
+        return LineCharts.get_plot(data=data, y_data='comments_count', start=start, end=end)
 
     @staticmethod
-    def reposts(data: pd.DataFrame) -> go.Figure:
-        return LineCharts.get_plot(data=data, y_data='reposts_count')
+    def reposts(data: pd.DataFrame, start: Optional[datetime.datetime] = None,
+              end: Optional[datetime.datetime] = None) -> go.Figure:
+        return LineCharts.get_plot(data=data, y_data='reposts_count', start=start, end=end)
 
 
 class NewsTable:
@@ -56,8 +164,29 @@ class NewsTable:
         return f'https://vk.com/{group_screen_name}?w=wall-{group_id}_{post_id}'
 
     @staticmethod
-    def update_news(posts_df: pd.DataFrame, groups_df: pd.DataFrame) -> List[Any]:
-        max_rows = 6
+    def get_news_feed(posts_df: pd.DataFrame, groups_df: pd.DataFrame, max_rows: int = 6) -> List[Dict[str, str]]:
+        """
+        Latest posts with rendered links, built once per data snapshot.
+        Posts of groups missing in groups frame are skipped
+
+        """
+        groups = {group['screen_name']: group for group in groups_df.to_dict('records')}
+        known_posts_df = posts_df[posts_df['group'].isin(list(groups))]
+        news_feed = []
+        for post in known_posts_df.nlargest(max_rows, 'date').to_dict('records'):
+            group = groups[post['group']]
+            news_feed.append({
+                'title': post['title'],
+                'href': NewsTable.get_post_href(
+                    group_screen_name=post['group'],
+                    post_id=post['post_id'],
+                    group_id=group['group_id']),
+                'tooltip': group['name'] + '\n' + str(post['date'])
+            })
+        return news_feed
+
+    @staticmethod
+    def update_news(news_feed: List[Dict[str, str]]) -> List[Any]:
         return [
             dbc.CardHeader(html.H4(children="Новости")),
             dbc.CardBody([
@@ -73,24 +202,16 @@ class NewsTable:
                                 html.Td(
                                     children=[
                                         html.A(
-                                            children=posts_df.iloc[i]["title"],
-                                            href=NewsTable.get_post_href(
-                                                group_screen_name=posts_df.iloc[i]["group"],
-                                                post_id=posts_df.iloc[i]["post_id"],
-                                                group_id=groups_df[
-                                                    groups_df['screen_name'] == posts_df.iloc[i]["group"]
-                                                    ].iloc[0]['group_id']),
-                                            title=groups_df[
-                                                      groups_df['screen_name'] == posts_df.iloc[i]["group"]
-                                                      ].iloc[0]['name'] + '\n' +
-                                                  str(posts_df.iloc[i]["date"]),
+                                            children=news['title'],
+                                            href=news['href'],
+                                            title=news['tooltip'],
                                             target="_blank",
                                         )
                                     ]
                                 )
                             ]
                         )
-                        for i in range(min(len(posts_df), max_rows))
+                        for news in news_feed
                     ],
                 ),
             ])
@@ -99,88 +220,220 @@ class NewsTable:
 
 class WordCloudPlots:
     stopwords = ['TJ', 'РИА', 'Новости', 'Медуза', 'РБК', 'Pro', 'СМИ', 'Тренд']
+    clientside_function = '''
+        function(data, timestamps) {
+            var hidden = {display: 'none'};
+            if (!data || !timestamps) {
+                return [{}, {}, hidden];
+            }
+            var counts = [];
+            data.entities.forEach(function(entity, i) {
+                var count = 0;
+                data.days.forEach(function(day, j) {
+                    if (day + 86400 > timestamps[0] && day <= timestamps[1]) {
+                        count += data.counts[i][j];
+                    }
+                });
+                if (count > 0) {
+                    counts.push([entity, count, data.colors[i]]);
+                }
+            });
+            if (!counts.length) {
+                return [{}, {}, {display: 'block'}];
+            }
+            counts.sort(function(a, b) {
+                return b[1] - a[1] || (a[0] < b[0] ? -1 : (a[0] > b[0] ? 1 : 0));
+            });
+            var grid = data.grid;
+            counts = counts.slice(0, grid.max_words);
+            var frequencies = counts.map(function(count) {
+                return [count[0], Math.round(count[1] / counts[0][1] * 1000) / 1000, count[2]];
+            });
+
+            var gridRows = Math.floor(grid.height / grid.cell_size), gridCols = Math.floor(grid.width / grid.cell_size);
+            var occupied = new Int32Array(gridRows * gridCols);
+            var integral = new Int32Array((gridRows + 1) * (gridCols + 1));
+            var words = [], freqs = [], sizes = [], xs = [], ys = [], colors = [];
+            frequencies.forEach(function(frequency) {
+                var word = frequency[0], fontSize = frequency[1] * grid.max_font_size;
+                while (fontSize > grid.min_font_size) {
+                    var rows = Math.max(1, Math.ceil(fontSize * grid.line_height / grid.cell_size));
+                    var cols = Math.max(1, Math.ceil(word.length * fontSize * grid.char_width / grid.cell_size));
+                    if (rows <= gridRows && cols <= gridCols) {
+                        var bestRow = -1, bestCol = -1, bestDistance = Infinity;
+                        for (var row = 0; row <= gridRows - rows; row++) {
+                            for (var col = 0; col <= gridCols - cols; col++) {
+                                var sum = integral[(row + rows) * (gridCols + 1) + col + cols]
+                                    - integral[row * (gridCols + 1) + col + cols]
+                                    - integral[(row + rows) * (gridCols + 1) + col]
+                                    + integral[row * (gridCols + 1) + col];
+                                if (sum === 0) {
+                                    var rowOffset = (row + rows / 2 - gridRows / 2) / gridRows;
+                                    var colOffset = (col + cols / 2 - gridCols / 2) / gridCols;
+                                    var distance = rowOffset * rowOffset + colOffset * colOffset;
+                                    if (distance < bestDistance) {
+                                        bestDistance = distance;
+                                        bestRow = row;
+                                        bestCol = col;
+                                    }
+                                }
+                            }
+                        }
+                        if (bestRow >= 0) {
+                            for (var placedRow = bestRow; placedRow < bestRow + rows; placedRow++) {
+                                occupied.fill(1, placedRow * gridCols + bestCol, placedRow * gridCols + bestCol + cols);
+                            }
+                            for (var r = 0; r < gridRows; r++) {
+                                var rowSum = 0;
+                                for (var c = 0; c < gridCols; c++) {
+                                    rowSum += occupied[r * gridCols + c];
+                                    integral[(r + 1) * (gridCols + 1) + c + 1] = integral[r * (gridCols + 1) + c + 1] + rowSum;
+                                }
+                            }
+                            words.push(word);
+                            freqs.push(frequency[1]);
+                            sizes.push(fontSize);
+                            xs.push((bestCol + cols / 2) * grid.cell_size);
+                            ys.push(grid.height - (bestRow + rows / 2) * grid.cell_size);
+                            colors.push(frequency[2]);
+                            break;
+                        }
+                    }
+                    fontSize *= grid.shrink_factor;
+                }
+            });
+
+            var top = frequencies.slice(0, 25).reverse();
+            var wordcloud = {
+                data: [{
+                    type: 'scatter',
+                    x: xs,
+                    y: ys,
+                    textfont: {size: sizes, color: colors},
+                    hoverinfo: 'text',
+                    textposition: 'middle center',
+                    hovertext: words.map(function(word, i) { return word + ' - ' + freqs[i]; }),
+                    mode: 'text',
+                    text: words
+                }],
+                layout: data.wordcloud_layout
+            };
+            var treemap = {
+                data: [{
+                    type: 'treemap',
+                    labels: top.map(function(frequency) { return frequency[0]; }),
+                    parents: top.map(function() { return ''; }),
+                    values: top.map(function(frequency) { return frequency[1]; })
+                }],
+                layout: data.treemap_layout
+            };
+            return [wordcloud, treemap, hidden];
+        }'''
+
+
+    @staticmethod
+    def get_wordcloud_layout() -> Dict[str, Any]:
+        return {
+            "paper_bgcolor": 'rgba(0,0,0,0)',
+            "plot_bgcolor": 'rgba(0,0,0,0)',
+            "xaxis": {
+                "showgrid": False,
+                "showticklabels": False,
+                "zeroline": False,
+                "automargin": True,
+                "range": [0, WordCloudLayout.width],
+            },
+            "yaxis": {
+                "showgrid": False,
+                "showticklabels": False,
+                "zeroline": False,
+                "automargin": True,
+                "range": [0, WordCloudLayout.height],
+            },
+            # "margin": dict(t=20, b=20, l=10, r=10, pad=4),
+            "margin": dict(t=10, b=10, l=5, r=5, pad=4),
+            "hovermode": "closest",
+        }
+
+    @staticmethod
+    def get_treemap_layout() -> Dict[str, Any]:
+        return {
+            "paper_bgcolor": 'rgba(0,0,0,0)',
+            "plot_bgcolor": 'rgba(0,0,0,0)',
+            "margin": dict(t=10, b=10, l=5, r=5, pad=4)
+        }
+
+    @classmethod
+    def get_counts_data(cls, entities: List[str], days: List[datetime.datetime], counts: np.ndarray) -> dict:
+        """
+        Per day counts of top entities, plots for any days range are built
+        from it by clientside_function with the same layout as get_frequency_plots
+
+        """
+        return {
+            'entities': entities,
+            'days': [int(day.timestamp()) for day in days],
+            'counts': counts.tolist(),
+            'colors': [WordCloudLayout.get_color(entity) for entity in entities],
+            'grid': {
+                'width': WordCloudLayout.width,
+                'height': WordCloudLayout.height,
+                'cell_size': WordCloudLayout.cell_size,
+                'max_words': WordCloudLayout.max_words,
+                'max_font_size': WordCloudLayout.max_font_size,
+                'min_font_size': WordCloudLayout.min_font_size,
+                'char_width': WordCloudLayout.char_width,
+                'line_height': WordCloudLayout.line_height,
+                'shrink_factor': WordCloudLayout.shrink_factor
+            },
+            'wordcloud_layout': cls.get_wordcloud_layout(),
+            'treemap_layout': cls.get_treemap_layout()
+        }
 
     @classmethod
     def get_plots(cls, data: pd.DataFrame) -> Any:
-        entities = dict(data["entity"].value_counts())
+        return cls.get_frequency_plots(data["entity"].value_counts())
 
-        if len(entities) < 1:
-            return {}, {}, {}
+    @classmethod
+    def get_frequency_plots(cls, entities_counts: pd.Series) -> Any:
+        entities_counts = entities_counts[entities_counts > 0]
+        frequencies = WordCloudLayout.get_frequencies(list(entities_counts.items()))
 
-        word_cloud = WordCloud(stopwords=set(cls.stopwords), max_words=100, max_font_size=90)
-        word_cloud.generate_from_frequencies(entities)
+        if len(frequencies) < 1:
+            return {}, {}, {}
 
         word_list = []
         freq_list = []
         fontsize_list = []
-        position_list = []
-        orientation_list = []
+        x_arr = []
+        y_arr = []
         color_list = []
 
-        for (word, freq), fontsize, position, orientation, color in word_cloud.layout_:
+        for word, freq, fontsize, x, y, color in WordCloudLayout.get_layout(frequencies):
             word_list.append(word)
             freq_list.append(freq)
             fontsize_list.append(fontsize)
-            position_list.append(position)
-            orientation_list.append(orientation)
+            x_arr.append(x)
+            y_arr.append(y)
             color_list.append(color)
 
-        # get the positions
-        x_arr = []
-        y_arr = []
-        for i in position_list:
-            x_arr.append(i[0])
-            y_arr.append(i[1])
-
-        # get the relative occurence frequencies
-        new_freq_list = []
-        for i in freq_list:
-            new_freq_list.append(i * 80)
-
-        new_freq_list = [freq for freq in filter(lambda f: f > 1, new_freq_list)]
-        color_list = color_list[:len(new_freq_list)]
-        word_list = word_list[:len(new_freq_list)]
-        freq_list = freq_list[:len(new_freq_list)]
-
         trace = go.Scatter(
             x=x_arr,
             y=y_arr,
-            textfont=dict(size=new_freq_list, color=color_list),
+            textfont=dict(size=fontsize_list, color=color_list),
             hoverinfo="text",
-            textposition="top center",
+            textposition="middle center",
             hovertext=["{0} - {1}".format(w, f) for w, f in zip(word_list, freq_list)],
             mode="text",
             text=word_list,
         )
 
-        layout = go.Layout(
-            {
-                "paper_bgcolor": 'rgba(0,0,0,0)',
-                "plot_bgcolor": 'rgba(0,0,0,0)',
-                "xaxis": {
-                    "showgrid": False,
-                    "showticklabels": False,
-                    "zeroline": False,
-                    "automargin": True,
-                    "range": [-100, 250],
-                },
-                "yaxis": {
-                    "showgrid": False,
-                    "showticklabels": False,
-                    "zeroline": False,
-                    "automargin": True,
-                    "range": [-100, 450],
-                },
-                # "margin": dict(t=20, b=20, l=10, r=10, pad=4),
-                "margin": dict(t=10, b=10, l=5, r=5, pad=4),
-                "hovermode": "closest",
-            }
-        )
+        layout = go.Layout(cls.get_wordcloud_layout())
 
         wordcloud_figure_data = {"data": [trace], "layout": layout}
-        word_list_top = word_list[:25]
+        word_list_top = [word for word, _ in frequencies[:25]]
         word_list_top.reverse()
-        freq_list_top = freq_list[:25]
+        freq_list_top = [freq for _, freq in frequencies[:25]]
         freq_list_top.reverse()
 
         frequency_figure_data = {
@@ -204,12 +457,6 @@ class WordCloudPlots:
         treemap_trace = go.Treemap(
             labels=word_list_top, parents=[""] * len(word_list_top), values=freq_list_top
         )
-        treemap_layout = go.Layout(
-            {
-                "paper_bgcolor": 'rgba(0,0,0,0)',
-                "plot_bgcolor": 'rgba(0,0,0,0)',
-                "margin": dict(t=10, b=10, l=5, r=5, pad=4)
-            }
-        )
+        treemap_layout = go.Layout(cls.get_treemap_layout())
         treemap_figure = {"data": [treemap_trace], "layout": treemap_layout}
         return wordcloud_figure_data, frequency_figure_data, treemap_figure
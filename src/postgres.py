@@ -1,6 +1,16 @@
-from typing import List, Generator
+import io
+import time
+import uuid
+import select
+import logging
+import datetime
+import threading
+import contextlib
+from typing import List, Dict, Generator, Optional, Callable, Any, Tuple
 
 import psycopg2
+import psycopg2.sql
+import psycopg2.pool
 import psycopg2.extras
 
 
@@ -8,41 +18,181 @@ class PostgresStorage:
     """
     Base class for all classes working with Postgres
 
+    Connections are taken from thread-safe pool, checked before use and
+    reopened with exponential backoff if Postgres becomes unavailable
+
     """
 
-    conn: psycopg2.extensions.connection
+    pool: psycopg2.pool.ThreadedConnectionPool
+    conn_params: Dict[str, Any]
+    slots: threading.BoundedSemaphore
+    itersize: int
+    copy_chunk_size: int
+    retries: int
+    backoff: float
+    connection_errors = (psycopg2.OperationalError, psycopg2.InterfaceError)
 
-    def __init__(self, conn: psycopg2.extensions.connection):
-        self.conn = conn
+    def __init__(self, pool: psycopg2.pool.ThreadedConnectionPool, conn_params: Dict[str, Any],
+                 itersize: int = 10000, copy_chunk_size: int = 50000, retries: int = 5, backoff: float = 1.0):
+        self.pool = pool
+        self.conn_params = conn_params
+        self.slots = threading.BoundedSemaphore(pool.maxconn)
+        self.itersize = itersize
+        self.copy_chunk_size = copy_chunk_size
+        self.retries = retries
+        self.backoff = backoff
 
     @classmethod
-    def connect(cls, dbname: str, user: str, password: str, host: str, port: int):
-        conn = psycopg2.connect(
+    def connect(cls, dbname: str, user: str, password: str, host: str, port: int, itersize: int = 10000,
+                copy_chunk_size: int = 50000, minconn: int = 1, maxconn: int = 4, retries: int = 5,
+                backoff: float = 1.0):
+        conn_params = dict(
             dbname=dbname,
             user=user,
             password=password,
             host=host,
             port=port)
-        return cls(conn=conn)
+        pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, **conn_params)
+        return cls(pool=pool, conn_params=conn_params, itersize=itersize, copy_chunk_size=copy_chunk_size,
+                   retries=retries, backoff=backoff)
+
+    def wait(self, attempt: int, error: Exception, forever: bool = False):
+        if attempt >= self.retries and not forever:
+            raise error
+        delay = self.backoff * 2 ** min(attempt, self.retries)
+        logging.warning('Postgres connection error: %s, retry in %.1fs' % (str(error).strip(), delay))
+        time.sleep(delay)
 
-    def exec_query(self, query: str, params: list) -> Generator:
-        cursor = self.conn.cursor()
+    def is_alive(self, conn: psycopg2.extensions.connection) -> bool:
+        if conn.closed:
+            return False
         try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except self.connection_errors:
+            return False
+
+    def get_connection(self) -> psycopg2.extensions.connection:
+        attempt = 0
+        while True:
+            try:
+                conn = self.pool.getconn()
+            except self.connection_errors as e:
+                self.wait(attempt, e)
+                attempt += 1
+                continue
+            if self.is_alive(conn):
+                return conn
+            logging.warning('Drop broken Postgres connection')
+            self.pool.putconn(conn, close=True)
+
+    @contextlib.contextmanager
+    def connection(self) -> Generator:
+        with self.slots:
+            conn = self.get_connection()
+            broken = False
+            try:
+                yield conn
+                conn.commit()
+            except self.connection_errors:
+                broken = True
+                raise
+            except BaseException:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                self.pool.putconn(conn, close=broken or bool(conn.closed))
+
+    def run(self, func: Callable[[psycopg2.extensions.cursor], Any]) -> Any:
+        attempt = 0
+        while True:
+            try:
+                with self.connection() as conn:
+                    with conn.cursor() as cursor:
+                        return func(cursor)
+            except self.connection_errors as e:
+                self.wait(attempt, e)
+                attempt += 1
+
+    def exec_query(self, query: str, params: list) -> List[tuple]:
+        def fetch(cursor: psycopg2.extensions.cursor) -> List[tuple]:
             cursor.execute(query, params)
-        except psycopg2.Error as e:
-            self.conn.rollback()
-            raise e
-        return cursor.fetchall()
+            return cursor.fetchall()
+
+        return self.run(fetch)
+
+    def stream_query(self, query: str, params: list, itersize: Optional[int] = None) -> Generator:
+        """
+        Yields query results in batches of itersize rows using server-side cursor
+
+        """
+        itersize = itersize or self.itersize
+        with self.connection() as conn:
+            with conn.cursor(name=f'stream_{uuid.uuid4().hex}') as cursor:
+                cursor.itersize = itersize
+                cursor.execute(query, params)
+                while True:
+                    batch = cursor.fetchmany(itersize)
+                    if not batch:
+                        break
+                    yield batch
 
     def insert_many(self, insert_query: str, data: List[tuple]):
-        cursor = self.conn.cursor()
-        try:
-            psycopg2.extras.execute_values(
-                cursor, insert_query, data)
-            self.conn.commit()
-        except psycopg2.Error as e:
-            self.conn.rollback()
-            raise e
+        self.run(lambda cursor: psycopg2.extras.execute_values(cursor, insert_query, data))
+
+    @staticmethod
+    def format_copy_value(value: Any) -> str:
+        if value is None:
+            return '\\N'
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+    def copy_rows(self, cursor: psycopg2.extensions.cursor, table: str, columns: List[str], rows: List[tuple]):
+        """
+        Writes rows with COPY FROM STDIN in text format
+
+        """
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write('\t'.join(map(self.format_copy_value, row)))
+            buffer.write('\n')
+        buffer.seek(0)
+        cursor.copy_expert(f'COPY {table}({", ".join(columns)}) FROM STDIN', buffer)
+
+    def notify(self, channel: str, payload: str = ''):
+        self.run(lambda cursor: cursor.execute('SELECT pg_notify(%s, %s)', [channel, payload]))
+
+    def listen(self, channel: str, timeout: float) -> Generator:
+        """
+        Yields payloads of notifications received on channel on dedicated connection,
+        empty list if nothing was received within timeout seconds. Reconnects forever
+
+        """
+        attempt = 0
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.conn_params)
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(psycopg2.sql.SQL('LISTEN {}').format(psycopg2.sql.Identifier(channel)))
+                attempt = 0
+                while True:
+                    if select.select([conn], [], [], timeout) == ([], [], []):
+                        yield []
+                        continue
+                    conn.poll()
+                    payloads = [notify.payload for notify in conn.notifies]
+                    conn.notifies.clear()
+                    yield payloads
+            except self.connection_errors as e:
+                self.wait(attempt, e, forever=True)
+                attempt += 1
+            finally:
+                if conn is not None:
+                    conn.close()
 
 
 class GroupsStorage(PostgresStorage):
@@ -61,25 +211,182 @@ class PostsStorage(PostgresStorage):
             FROM posts''', []
         return list(self.exec_query(query, params))
 
-    def get_unprocessed_posts(self) -> List[tuple]:
-        query, params = '''
-            SELECT post_id, group_screen_name, date, title, text, 
+    def stream_posts(self, since: Optional[datetime.datetime] = None, with_text: bool = True) -> Generator:
+        text_column = 'text' if with_text else 'NULL'
+        query, params = f'''
+            SELECT post_id, group_screen_name, date, title, {text_column}, 
                    likes_count, views_count, comments_count, reposts_count
-            FROM posts 
-            WHERE date > (SELECT MAX(date) FROM entities)''', []
+            FROM posts''', []
+        if since is not None:
+            query, params = query + ' WHERE date >= %s', [since]
+        return self.stream_query(query, params)
+
+    def refresh_posts_daily_stats(self):
+        self.run(lambda cursor: cursor.execute('REFRESH MATERIALIZED VIEW CONCURRENTLY posts_daily_stats'))
+
+    def get_groups_stats(self) -> List[tuple]:
+        query, params = '''
+            SELECT group_screen_name, SUM(posts_count),
+                   SUM(views_sum)::float8 / SUM(posts_count), SUM(likes_sum)::float8 / SUM(posts_count),
+                   SUM(comments_sum)::float8 / SUM(posts_count), SUM(reposts_sum)::float8 / SUM(posts_count)
+            FROM posts_daily_stats
+            GROUP BY group_screen_name''', []
         return list(self.exec_query(query, params))
 
 
 class EntitiesStorage(PostgresStorage):
+    entities_columns = ['post_id', 'type', 'date', 'entity']
+    entities_merge_query = '''
+        WITH inserted AS (
+            INSERT INTO entities(post_id, type, date, entity)
+            SELECT post_id, type, date, entity FROM entities_staging
+            ON CONFLICT DO NOTHING
+            RETURNING post_id, type, date, entity
+        ), rollup AS (
+            INSERT INTO entities_daily(group_screen_name, type, day, entity, count)
+            SELECT p.group_screen_name, i.type, i.date::date, i.entity, COUNT(*)
+            FROM inserted i
+            JOIN posts p ON p.post_id = i.post_id AND p.date = i.date
+            GROUP BY p.group_screen_name, i.type, i.date::date, i.entity
+            ON CONFLICT (group_screen_name, type, day, entity)
+            DO UPDATE SET count = entities_daily.count + EXCLUDED.count
+        )
+        SELECT COUNT(*) FROM inserted'''
 
     def get_entities(self) -> List[tuple]:
         query, params = 'SELECT post_id, type, date, entity FROM entities', []
         return list(self.exec_query(query, params))
 
-    def add_entities(self, entities_list: List[tuple]):
-        insert_query = 'INSERT INTO entities(post_id, type, date, entity) VALUES %s'
-        self.insert_many(insert_query, entities_list)
+    def stream_entities(self, since: Optional[datetime.datetime] = None) -> Generator:
+        query, params = 'SELECT post_id, type, date, entity FROM entities', []
+        if since is not None:
+            query, params = query + ' WHERE date >= %s', [since]
+        return self.stream_query(query, params)
+
+    def copy_entities(self, cursor: psycopg2.extensions.cursor, entities_list: List[tuple]) -> int:
+        """
+        Copies entities into staging table and merges them into entities and
+        entities daily rollup, skipping already stored ones. Rows with missing
+        values are skipped. Returns count of added entities
+
+        """
+        valid_entities = [entity for entity in entities_list if all(entity)]
+        if len(valid_entities) < len(entities_list):
+            logging.warning('Skip %d invalid entities' % (len(entities_list) - len(valid_entities)))
+        cursor.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS entities_staging (
+                post_id INTEGER,
+                type TEXT,
+                date TIMESTAMP,
+                entity TEXT
+            ) ON COMMIT DROP;
+            TRUNCATE entities_staging''')
+        self.copy_rows(cursor, 'entities_staging', self.entities_columns, valid_entities)
+        cursor.execute(self.entities_merge_query)
+        return cursor.fetchone()[0]
+
+    def add_entities(self, entities_list: List[tuple], chunk_size: Optional[int] = None) -> int:
+        """
+        Stores entities with COPY, committing every chunk_size rows,
+        so failed chunk does not roll back already stored ones
+
+        """
+        chunk_size = chunk_size or self.copy_chunk_size
+        added = 0
+        for start in range(0, len(entities_list), chunk_size):
+            chunk = entities_list[start:start + chunk_size]
+            added += self.run(lambda cursor: self.copy_entities(cursor, chunk))
+        return added
+
+    def stream_entities_daily(self, since: Optional[datetime.date] = None) -> Generator:
+        query, params = 'SELECT group_screen_name, type, day, entity, count FROM entities_daily', []
+        if since is not None:
+            query, params = query + ' WHERE day >= %s', [since]
+        return self.stream_query(query, params)
 
 
 class Storage(GroupsStorage, PostsStorage, EntitiesStorage):
-    pass
+    claim_query = '''
+        WITH claimed AS (
+            DELETE FROM unprocessed_posts
+            WHERE (group_screen_name, post_id) IN (
+                SELECT group_screen_name, post_id
+                FROM unprocessed_posts
+                {condition}
+                ORDER BY attempts, date
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING group_screen_name, post_id
+        )
+        SELECT p.post_id, p.group_screen_name, p.date, p.title, p.text,
+               p.likes_count, p.views_count, p.comments_count, p.reposts_count
+        FROM posts p
+        JOIN claimed c ON c.group_screen_name = p.group_screen_name AND c.post_id = p.post_id
+        ORDER BY p.date'''
+
+    def process_unprocessed_posts(self, handler: Callable[[List[tuple]], List[tuple]],
+                                  limit: int, max_attempts: int = 3) -> Tuple[int, int]:
+        """
+        Claims up to limit queued posts, extracts entities with handler and
+        stores them in the same transaction, so each post is processed exactly once.
+        Posts of failed batch are retried one by one, post failed max_attempts times
+        is moved to failed_posts, posts failed before are claimed after new ones.
+        Returns count of processed posts and added entities
+
+        """
+        def process(cursor: psycopg2.extensions.cursor, condition: str, params: list) -> Tuple[int, int]:
+            cursor.execute(self.claim_query.format(condition=condition), params)
+            posts_list = cursor.fetchall()
+            entities_list = handler(posts_list) if posts_list else []
+            entities_count = self.copy_entities(cursor, entities_list) if entities_list else 0
+            return len(posts_list), entities_count
+
+        try:
+            return self.run(lambda cursor: process(cursor, '', [limit]))
+        except self.connection_errors:
+            raise
+        except Exception:
+            logging.exception('Failed to process batch of queued posts, retry them one by one')
+
+        posts_count, entities_count = 0, 0
+        keys = self.exec_query(
+            'SELECT group_screen_name, post_id FROM unprocessed_posts ORDER BY attempts, date LIMIT %s', [limit])
+        for group_screen_name, post_id in keys:
+            try:
+                counts = self.run(lambda cursor: process(
+                    cursor, 'WHERE group_screen_name = %s AND post_id = %s', [group_screen_name, post_id, 1]))
+            except self.connection_errors:
+                raise
+            except Exception as e:
+                logging.exception('Failed to process post %s of %s' % (post_id, group_screen_name))
+                self.add_failed_attempt(group_screen_name, post_id, repr(e), max_attempts)
+                continue
+            posts_count += counts[0]
+            entities_count += counts[1]
+        return posts_count, entities_count
+
+    def add_failed_attempt(self, group_screen_name: str, post_id: int, error: str, max_attempts: int):
+        def add(cursor: psycopg2.extensions.cursor):
+            cursor.execute('''
+                UPDATE unprocessed_posts SET attempts = attempts + 1
+                WHERE group_screen_name = %s AND post_id = %s
+                RETURNING attempts''', [group_screen_name, post_id])
+            row = cursor.fetchone()
+            if row is None or row[0] < max_attempts:
+                return
+            cursor.execute('''
+                WITH failed AS (
+                    DELETE FROM unprocessed_posts
+                    WHERE group_screen_name = %s AND post_id = %s
+                    RETURNING post_id, group_screen_name, date, attempts
+                )
+                INSERT INTO failed_posts(post_id, group_screen_name, date, attempts, error)
+                SELECT post_id, group_screen_name, date, attempts, %s FROM failed
+                ON CONFLICT (group_screen_name, post_id) DO UPDATE
+                SET attempts = EXCLUDED.attempts, error = EXCLUDED.error, failed_at = now()''',
+                           [group_screen_name, post_id, error])
+            logging.warning('Move post %s of %s to failed posts after %d attempts' % (
+                post_id, group_screen_name, row[0]))
+
+        self.run(add)
@@ -1,96 +1,254 @@
 import re
+import sys
+import logging
 import datetime
-from typing import List
+from typing import List, Dict, Iterable, Optional
 
+import numpy as np
 import pandas as pd
 import pymorphy2
 
+int32_info = np.iinfo(np.int32)
+
 
 class TextProcessor:
-    morph = pymorphy2.MorphAnalyzer()
+    morph: Optional[pymorphy2.MorphAnalyzer] = None
     pattern = re.compile(r'\W')
     not_digit = re.compile(r'\D')
     functors_pos = {'INTJ', 'PRCL', 'CONJ', 'PREP'}
+    time_shift = datetime.timedelta(hours=3)
+    counters_columns = ['likes_count', 'views_count', 'comments_count', 'reposts_count']
+    means_columns = ['views_mean', 'likes_mean', 'comments_mean', 'reposts_mean']
+    posts_categories = ['group']
+    entities_columns = ['post_id', 'type', 'date', 'entity']
+    entities_categories = ['type', 'entity']
+    entities_daily_categories = ['group', 'type', 'entity']
+
+    @classmethod
+    def get_morph(cls) -> pymorphy2.MorphAnalyzer:
+        if cls.morph is None:
+            cls.morph = pymorphy2.MorphAnalyzer()
+        return cls.morph
 
     def pos(self, word: str) -> bool:
-        return self.morph.parse(word)[0].tag.POS
+        return self.get_morph().parse(word)[0].tag.POS
 
     def convert(self, text: str) -> str:
         words = [self.pattern.sub('', word) for word in text.split() if self.pos(word) not in self.functors_pos]
         words = [word for word in words if self.not_digit.match(word)]
-        words = [self.morph.normal_forms(w)[0] for w in words]
+        words = [self.get_morph().normal_forms(w)[0] for w in words]
         return ' '.join(words)
 
     @classmethod
     def parse_title(cls, title: str) -> str:
+        """
+        Wraps long title with '<br>' at first spaces after 60, 120 and 180 characters
+
+        """
         if len(title) < 80:
             return title
-        processed_title = ''
+        breaks = []
         one_newline = False
-        for i, ch in enumerate(title):
-            if 60 < i < 120 and ch == ' ' and not one_newline:
-                processed_title += '<br>'
-                one_newline = True
-            if 120 < i < 180 and ch == ' ' and one_newline:
-                processed_title += '<br>'
+        first_space = title.find(' ', 61, 120)
+        if first_space != -1:
+            breaks.append((first_space, first_space))
+            one_newline = True
+            second_space = title.find(' ', 121, 180)
+            if second_space != -1:
+                breaks.append((second_space, second_space))
                 one_newline = False
-            if 180 < i and ch == ' ' and not one_newline:
-                processed_title += '<br>'
-                one_newline = True
-            else:
-                processed_title += ch
-        return processed_title
+        if not one_newline:
+            third_space = title.find(' ', 181)
+            if third_space != -1:
+                breaks.append((third_space, third_space + 1))
+        parts = []
+        start = 0
+        for position, next_start in breaks:
+            parts.append(title[start:position])
+            parts.append('<br>')
+            start = next_start
+        parts.append(title[start:])
+        return ''.join(parts)
+
+    @classmethod
+    def get_row_size(cls, df: pd.DataFrame) -> float:
+        return df.memory_usage(deep=True).sum() / max(len(df), 1)
+
+    @classmethod
+    def compact(cls, df: pd.DataFrame, categories: List[str], name: Optional[str] = None) -> pd.DataFrame:
+        """
+        Stores repeated strings as categories and downcasts integer columns.
+        If name is given, logs memory usage per row before and after
+
+        """
+        row_size = cls.get_row_size(df) if name else 0
+        for column in categories:
+            df[column] = df[column].astype('category')
+        for column in df.select_dtypes(include='integer').columns:
+            values = df[column].values
+            if len(values) and int32_info.min <= values.min() and values.max() <= int32_info.max:
+                df[column] = values.astype(np.int32)
+        if name:
+            logging.info('Compact %s frame: %.1f -> %.1f bytes per row' % (name, row_size, cls.get_row_size(df)))
+        return df
+
+    @classmethod
+    def read_columns(cls, batches: Iterable[List[tuple]], indexes: Dict[str, int]) -> Dict[str, list]:
+        columns = {column: [] for column in indexes}
+        for batch in batches:
+            for column, index in indexes.items():
+                columns[column].extend(row[index] for row in batch)
+        return columns
 
     @classmethod
     def parse_groups(cls, groups_list: List[tuple]) -> pd.DataFrame:
-        return pd.DataFrame({
-            'group_id': [group[0] for group in groups_list],
-            'name': [group[2] for group in groups_list],
-            'screen_name': [group[1] for group in groups_list],
-            'members_count': [group[3] for group in groups_list]
-        })
+        return pd.DataFrame(cls.read_columns([groups_list], {
+            'group_id': 0,
+            'name': 2,
+            'screen_name': 1,
+            'members_count': 3
+        }))
+
+    @classmethod
+    def parse_groups_stats(cls, groups_df: pd.DataFrame, stats_list: List[tuple]) -> pd.DataFrame:
+        stats_df = pd.DataFrame(stats_list, columns=['screen_name', 'posts_count'] + cls.means_columns)
+        df = groups_df.merge(stats_df, on='screen_name', how='left')
+        df[['posts_count'] + cls.means_columns] = df[['posts_count'] + cls.means_columns].fillna(0)
+        return df
+
+    @classmethod
+    def format_dates(cls, dates: pd.Series) -> pd.Series:
+        """
+        Same as str() of each date, but formatted by numpy when dates have no fractional seconds
+
+        """
+        values = dates.values
+        seconds = values.astype('datetime64[s]')
+        if (seconds != values).any():
+            return dates.map(str)
+        return pd.Series(np.char.replace(seconds.astype(str), 'T', ' '), index=dates.index, dtype=object)
+
+    @classmethod
+    def get_hovertext(cls, df: pd.DataFrame) -> pd.Series:
+        if df.empty:
+            return pd.Series([], index=df.index, dtype=object)
+        return pd.Series([
+            f'<b>{title}</b><br><br>'
+            f'Дата: {date}<br>'
+            f'Лайки: {likes}<br>'
+            f'Комментарии: {comments}<br>'
+            f'Просмотры: {views}<br>'
+            f'Репосты: {reposts}'
+            for title, date, likes, comments, views, reposts in zip(
+                map(cls.parse_title, df['title'].values),
+                cls.format_dates(df['date']).values,
+                df['likes_count'].values.tolist(),
+                df['comments_count'].values.tolist(),
+                df['views_count'].values.tolist(),
+                df['reposts_count'].values.tolist())
+        ], index=df.index, dtype=object)
 
     @classmethod
     def parse_posts(cls, posts_list: List[tuple]) -> pd.DataFrame:
-        df = pd.DataFrame({
-            'post_id': [post[0] for post in posts_list],
-            'title': [post[3] for post in posts_list],
-            'text': [post[4] for post in posts_list],
-            'group': [post[1] for post in posts_list],
-            'likes_count': [post[5] for post in posts_list],
-            'views_count': [post[6] for post in posts_list],
-            'comments_count': [post[7] for post in posts_list],
-            'reposts_count': [post[8] for post in posts_list],
-            'date': [post[2] + datetime.timedelta(hours=3) for post in posts_list]
+        return cls.parse_posts_batches([posts_list])
+
+    @classmethod
+    def parse_posts_batches(cls, batches: Iterable[List[tuple]], report: bool = False) -> pd.DataFrame:
+        """
+        Builds dashboard posts frame. Post text is not displayed, so it is dropped
+
+        """
+        columns = cls.read_columns(batches, {
+            'post_id': 0,
+            'title': 3,
+            'group': 1,
+            'likes_count': 5,
+            'views_count': 6,
+            'comments_count': 7,
+            'reposts_count': 8,
+            'date': 2
         })
-        df['hovertext'] = df.apply(lambda row: '<b>' + TextProcessor.parse_title(row['title']) + '</b><br><br>' +
-                                               'Дата: ' + str(row['date']) + '<br>' +
-                                               'Лайки: ' + str(row['likes_count']) + '<br>' +
-                                               'Комментарии: ' + str(row['comments_count']) + '<br>' +
-                                               'Просмотры: ' + str(row['views_count']) + '<br>' +
-                                               'Репосты: ' + str(row['reposts_count']), axis=1)
+        columns['date'] = [date + cls.time_shift for date in columns['date']]
+        columns['group'] = [sys.intern(group) for group in columns['group']]
+        df = pd.DataFrame(columns)
+        df['hovertext'] = cls.get_hovertext(df)
+        df = cls.compact(df, cls.posts_categories, name='posts' if report else None)
         return df.sort_values(by=['date'], ascending=False)
 
+    @classmethod
+    def append_posts(cls, posts_df: pd.DataFrame, new_posts_df: pd.DataFrame) -> pd.DataFrame:
+        df = pd.concat([new_posts_df, posts_df], ignore_index=True)
+        df = df.drop_duplicates(subset=['group', 'post_id'], keep='first')
+        return cls.compact(df, cls.posts_categories).sort_values(by=['date'], ascending=False)
+
+    @classmethod
+    def get_entity_name(cls, entity_type: str, entity: str) -> str:
+        if entity_type == 'PER':
+            return sys.intern(entity.split()[-1])
+        return sys.intern(entity)
+
     @classmethod
     def parse_entities(cls, entities_list: List[tuple]) -> pd.DataFrame:
+        return cls.parse_entities_batches([entities_list])
+
+    @classmethod
+    def parse_entities_batches(cls, batches: Iterable[List[tuple]], report: bool = False) -> pd.DataFrame:
         post_ids = []
         types = []
         dates = []
         entities = []
-        for entity in entities_list:
-            post_ids.append(entity[0])
-            types.append(entity[1])
-            dates.append(entity[2])
-            if entity[1] == 'PER':
-                entities.append(entity[3].split()[-1])
-            else:
-                entities.append(entity[3])
-        return pd.DataFrame({
+        for batch in batches:
+            for entity in batch:
+                post_ids.append(entity[0])
+                types.append(sys.intern(entity[1]))
+                dates.append(entity[2])
+                entities.append(cls.get_entity_name(entity[1], entity[3]))
+        df = pd.DataFrame({
             'post_id': post_ids,
             'type': types,
             'date': dates,
             'entity': entities
         })
+        return cls.compact(df, cls.entities_categories, name='entities' if report else None)
+
+    @classmethod
+    def append_entities(cls, entities_df: pd.DataFrame, new_entities_df: pd.DataFrame,
+                        since: datetime.datetime) -> pd.DataFrame:
+        """
+        Replaces entities dated since given date with new ones, which are all
+        stored entities since then, and drops duplicates of the same mention
+
+        """
+        df = pd.concat([
+            entities_df.loc[entities_df['date'] < since, cls.entities_columns],
+            new_entities_df
+        ], ignore_index=True)
+        df = df.drop_duplicates(subset=['post_id', 'date', 'entity'], keep='last')
+        return cls.compact(df, cls.entities_categories)
+
+    @classmethod
+    def parse_entities_daily_batches(cls, batches: Iterable[List[tuple]], report: bool = False) -> pd.DataFrame:
+        columns = {'group': [], 'type': [], 'day': [], 'entity': [], 'count': []}
+        for batch in batches:
+            for group, entity_type, day, entity, count in batch:
+                columns['group'].append(sys.intern(group))
+                columns['type'].append(sys.intern(entity_type))
+                columns['day'].append(day)
+                columns['entity'].append(cls.get_entity_name(entity_type, entity))
+                columns['count'].append(count)
+        df = pd.DataFrame(columns)
+        df['day'] = pd.to_datetime(df['day'])
+        df = df.groupby(['group', 'type', 'day', 'entity'], as_index=False, sort=False)['count'].sum()
+        return cls.compact(df, cls.entities_daily_categories, name='entities daily' if report else None)
+
+    @classmethod
+    def append_entities_daily(cls, entities_daily_df: pd.DataFrame, new_entities_daily_df: pd.DataFrame,
+                              since: datetime.date) -> pd.DataFrame:
+        df = pd.concat([
+            entities_daily_df[entities_daily_df['day'] < pd.Timestamp(since)],
+            new_entities_daily_df
+        ], ignore_index=True)
+        return cls.compact(df, cls.entities_daily_categories)
 
     @classmethod
     def process_entities_df(cls, entities_df: pd.DataFrame) -> pd.DataFrame:
@@ -0,0 +1,312 @@
+import time
+import logging
+import datetime
+import itertools
+from typing import List, Dict, Tuple, Optional, Any, Iterator
+
+import numpy as np
+import pandas as pd
+
+from src.plots import NewsTable
+from src.postgres import Storage
+from src.preprocessing import TextProcessor
+
+
+class DataSnapshot:
+    """
+    Immutable dashboard data with per-group indexes built once at refresh time,
+    so callbacks do dict lookups and date slices instead of full scans.
+    Frames are sorted by group (and entity type), so per-group frames are row slices
+    sharing memory with the whole frame.
+    Refresh builds new snapshot which is published by single reference swap
+
+    """
+
+    version: int
+    built_at: datetime.datetime
+    loaded_at: datetime.datetime
+    posts_df: pd.DataFrame
+    groups_df: pd.DataFrame
+    entities_df: pd.DataFrame
+    entities_daily_df: pd.DataFrame
+    group_entities_df: pd.DataFrame
+    groups: Dict[str, pd.Series]
+    group_posts: Dict[str, pd.DataFrame]
+    group_entities: Dict[Tuple[str, str], pd.DataFrame]
+    group_entities_daily: Dict[Tuple[str, str], pd.DataFrame]
+    entity_types: Dict[str, List[str]]
+    news_feed: List[Dict[str, str]]
+    versions = itertools.count(1)
+
+    def __init__(self, posts_df: pd.DataFrame, groups_df: pd.DataFrame, entities_df: pd.DataFrame,
+                 entities_daily_df: pd.DataFrame, group_entities_df: Optional[pd.DataFrame] = None,
+                 loaded_at: Optional[datetime.datetime] = None):
+        """
+        group_entities_df is entities joined with posts groups. If it is given,
+        all frames must be already sorted as by previously built snapshot.
+        loaded_at is time of full load this snapshot is refreshed from
+
+        """
+        self.version = next(self.versions)
+        self.built_at = datetime.datetime.now()
+        self.loaded_at = loaded_at or self.built_at
+        if group_entities_df is None:
+            posts_df = posts_df.sort_values(by=['group', 'date'], ascending=[True, False], kind='mergesort')
+            # post_id is unique only within group, entities reference post by (post_id, raw post date)
+            posts_groups_df = pd.DataFrame({
+                'post_id': posts_df['post_id'].values,
+                'date': posts_df['date'] - TextProcessor.time_shift,
+                'group': posts_df['group'].values
+            }).drop_duplicates(subset=['post_id', 'date'])
+            group_entities_df = entities_df.merge(
+                posts_groups_df, on=['post_id', 'date']
+            ).sort_values(by=['group', 'type', 'date'], kind='mergesort')
+            entities_daily_df = entities_daily_df.sort_values(by=['group', 'type', 'day'], kind='mergesort')
+        self.posts_df = posts_df
+        self.groups_df = groups_df
+        self.entities_df = entities_df
+        self.entities_daily_df = entities_daily_df
+        self.group_entities_df = group_entities_df
+
+        self.groups = {group['name']: group for _, group in groups_df.iterrows()}
+        self.group_posts = {
+            screen_name: posts_df.iloc[start:end]
+            for screen_name, (start, end) in self.get_slices(posts_df, ['group']).items()
+        }
+        self.group_entities = {
+            key: group_entities_df.iloc[start:end]
+            for key, (start, end) in self.get_slices(group_entities_df, ['group', 'type']).items()
+        }
+        self.group_entities_daily = {
+            key: entities_daily_df.iloc[start:end]
+            for key, (start, end) in self.get_slices(entities_daily_df, ['group', 'type']).items()
+        }
+        self.entity_types = {}
+        for screen_name, entity_type in itertools.chain(self.group_entities, self.group_entities_daily):
+            types = self.entity_types.setdefault(screen_name, [])
+            if entity_type not in types:
+                types.append(entity_type)
+
+        self.news_feed = NewsTable.get_news_feed(posts_df, groups_df)
+        self.frozen = True
+
+    @staticmethod
+    def get_slices(df: pd.DataFrame, columns: List[str]) -> Dict[Any, Tuple[int, int]]:
+        """
+        Returns row ranges of equal values of columns in frame sorted by them.
+        Keys are values for one column and tuples of values for several
+
+        """
+        if df.empty:
+            return {}
+        change = np.zeros(len(df), dtype=bool)
+        change[0] = True
+        for column in columns:
+            values = df[column]
+            values = values.cat.codes.values if isinstance(values.dtype, pd.CategoricalDtype) else values.values
+            change[1:] |= values[1:] != values[:-1]
+        starts = np.flatnonzero(change)
+        ends = np.append(starts[1:], len(df))
+        keys = [df[column].values[starts] for column in columns]
+        keys = keys[0] if len(columns) == 1 else zip(*keys)
+        return {key: (int(start), int(end)) for key, start, end in zip(keys, starts, ends)}
+
+    def get_entity_types(self, screen_name: str, entity_type: str) -> List[str]:
+        if entity_type == 'ALL':
+            return self.entity_types.get(screen_name, [])
+        return [entity_type]
+
+    def get_watermarks(self) -> Optional[Tuple[datetime.datetime, datetime.datetime]]:
+        """
+        Returns raw dates of newest loaded post and entity, refresh loads
+        rows since them. None if there is no data yet
+
+        """
+        if self.posts_df.empty or self.entities_df.empty:
+            return None
+        return (
+            (self.posts_df['date'].max() - TextProcessor.time_shift).to_pydatetime(),
+            self.entities_df['date'].max().to_pydatetime())
+
+    def __setattr__(self, name: str, value):
+        if getattr(self, 'frozen', False):
+            raise AttributeError('DataSnapshot is immutable')
+        super().__setattr__(name, value)
+
+    @classmethod
+    def load(cls, storage: Storage) -> 'DataSnapshot':
+        start = time.time()
+        posts_df = TextProcessor.parse_posts_batches(storage.stream_posts(with_text=False), report=True)
+        posts_loaded = time.time()
+        groups_df = TextProcessor.parse_groups_stats(
+            TextProcessor.parse_groups(storage.get_groups()), storage.get_groups_stats())
+        groups_loaded = time.time()
+        entities_df = TextProcessor.parse_entities_batches(storage.stream_entities(), report=True)
+        entities_loaded = time.time()
+        entities_daily_df = TextProcessor.parse_entities_daily_batches(storage.stream_entities_daily(), report=True)
+        entities_daily_loaded = time.time()
+        snapshot = cls(
+            posts_df=posts_df,
+            groups_df=groups_df,
+            entities_df=entities_df,
+            entities_daily_df=entities_daily_df)
+        logging.info('Loaded snapshot %d: posts %.1fs, groups %.1fs, entities %.1fs, '
+                     'entities daily %.1fs, indexes %.1fs' % (
+                         snapshot.version,
+                         posts_loaded - start,
+                         groups_loaded - posts_loaded,
+                         entities_loaded - groups_loaded,
+                         entities_daily_loaded - entities_loaded,
+                         time.time() - entities_daily_loaded))
+        return snapshot
+
+    def refresh(self, storage: Storage, counters_window: datetime.timedelta) -> 'DataSnapshot':
+        """
+        Builds new snapshot from rows dated since counters_window before current
+        high-water marks. Rows of this window replace loaded ones, so posts
+        inserted late with older dates, their entities and updated counters are picked up
+
+        """
+        watermarks = self.get_watermarks()
+        if watermarks is None:
+            return self.load(storage)
+        posts_since, entities_since = (watermark - counters_window for watermark in watermarks)
+
+        new_posts_df = TextProcessor.parse_posts_batches(storage.stream_posts(since=posts_since, with_text=False))
+        new_entities_df = TextProcessor.parse_entities_batches(storage.stream_entities(since=entities_since))
+        new_entities_daily_df = TextProcessor.parse_entities_daily_batches(
+            storage.stream_entities_daily(since=entities_since.date()))
+
+        return DataSnapshot(
+            posts_df=TextProcessor.append_posts(self.posts_df, new_posts_df),
+            groups_df=TextProcessor.parse_groups_stats(
+                TextProcessor.parse_groups(storage.get_groups()), storage.get_groups_stats()),
+            entities_df=TextProcessor.append_entities(self.entities_df, new_entities_df, entities_since),
+            entities_daily_df=TextProcessor.append_entities_daily(
+                self.entities_daily_df, new_entities_daily_df, entities_since.date()),
+            loaded_at=self.loaded_at)
+
+    def get_group(self, group_name: str) -> pd.Series:
+        return self.groups[group_name]
+
+    def get_group_posts(self, screen_name: str) -> pd.DataFrame:
+        return self.group_posts.get(screen_name, self.posts_df.iloc[:0])
+
+    def get_group_entities(self, screen_name: str, entity_type: str,
+                           start_date: datetime.datetime, end_date: datetime.datetime) -> pd.DataFrame:
+        """
+        Returns group entities within window. Entities of type 'ALL'
+        are concatenated by type, so they are not sorted by date
+
+        """
+        parts = []
+        for group_entities in self.get_type_frames(self.group_entities, screen_name, entity_type):
+            dates = group_entities['date'].values
+            start = dates.searchsorted(pd.Timestamp(start_date).to_datetime64(), side='left')
+            end = dates.searchsorted(pd.Timestamp(end_date).to_datetime64(), side='right')
+            parts.append(group_entities.iloc[start:end])
+        if not parts:
+            return self.group_entities_df.iloc[:0]
+        return parts[0] if len(parts) == 1 else pd.concat(parts)
+
+    def get_type_frames(self, frames: Dict[Tuple[str, str], pd.DataFrame],
+                        screen_name: str, entity_type: str) -> List[pd.DataFrame]:
+        return [
+            frames[(screen_name, type_name)]
+            for type_name in self.get_entity_types(screen_name, entity_type)
+            if (screen_name, type_name) in frames
+        ]
+
+    def get_entities_counts(self, screen_name: str, entity_type: str,
+                            start_date: datetime.datetime, end_date: datetime.datetime) -> pd.Series:
+        """
+        Returns mentions count of each entity within window, sorted by count.
+        Whole days are summed from daily rollup, partial days at window
+        edges are counted from raw entities rows
+
+        """
+        start_day = pd.Timestamp(start_date).ceil('D')
+        end_day = pd.Timestamp(end_date).floor('D')
+        if start_day >= end_day:
+            counts = self.get_group_entities(screen_name, entity_type, start_date, end_date)['entity'].value_counts()
+        else:
+            parts = [
+                self.get_group_entities(screen_name, entity_type, start_date, start_day - pd.Timedelta(1)),
+                self.get_group_entities(screen_name, entity_type, end_day, end_date)
+            ]
+            daily_counts = [pd.Series([], dtype='int64')]
+            for group_entities_daily in self.get_type_frames(self.group_entities_daily, screen_name, entity_type):
+                days = group_entities_daily['day'].values
+                start = days.searchsorted(start_day.to_datetime64(), side='left')
+                end = days.searchsorted(end_day.to_datetime64(), side='left')
+                daily_counts.append(group_entities_daily.iloc[start:end].groupby(
+                    'entity', observed=True)['count'].sum())
+            counts = pd.concat(
+                daily_counts + [part['entity'].value_counts() for part in parts]
+            ).groupby(level=0).sum()
+        counts = counts[counts > 0]
+        return counts.sort_values(ascending=False, kind='mergesort')
+
+    def get_entities_matrix(self, screen_name: str, entity_type: str,
+                            top_k: int) -> Tuple[List[str], List[datetime.datetime], np.ndarray]:
+        """
+        Returns top_k entities by total mentions, days and matrix of
+        their mentions count per day with shape (entities, days)
+
+        """
+        type_frames = self.get_type_frames(self.group_entities_daily, screen_name, entity_type)
+        if not type_frames:
+            return [], [], np.zeros((0, 0), dtype=np.int64)
+        group_entities_daily = type_frames[0] if len(type_frames) == 1 else pd.concat(type_frames)
+        counts = group_entities_daily.groupby(['entity', 'day'], observed=True)['count'].sum()
+        totals = counts.groupby(level=0, observed=True).sum().sort_values(ascending=False, kind='mergesort')
+        top_entities = list(totals.index[:top_k])
+        matrix = counts[counts.index.get_level_values(0).isin(top_entities)].unstack(fill_value=0)
+        matrix = matrix.reindex(top_entities)
+        return top_entities, [day.to_pydatetime() for day in matrix.columns], matrix.values.astype(np.int64)
+
+
+class SnapshotLoader:
+    """
+    Keeps snapshot up to date: loads it on start and every full_reload_interval
+    seconds, otherwise refreshes it with rows added since previous snapshot.
+    Started with persisted snapshot, it only loads rows added since it was saved
+
+    """
+
+    storage: Storage
+    full_reload_interval: int
+    counters_window: datetime.timedelta
+    snapshot: Optional[DataSnapshot]
+
+    def __init__(self, storage: Storage, full_reload_interval: int, counters_window: datetime.timedelta,
+                 snapshot: Optional[DataSnapshot] = None):
+        self.storage = storage
+        self.full_reload_interval = full_reload_interval
+        self.counters_window = counters_window
+        self.snapshot = snapshot
+
+    def update(self) -> DataSnapshot:
+        if self.snapshot is None or (
+                datetime.datetime.now() - self.snapshot.loaded_at).total_seconds() >= self.full_reload_interval:
+            self.snapshot = DataSnapshot.load(self.storage)
+        else:
+            self.snapshot = self.snapshot.refresh(self.storage, self.counters_window)
+        logging.info('Built data snapshot %d at %s' % (self.snapshot.version, self.snapshot.built_at))
+        return self.snapshot
+
+    def follow(self, channel: str, timeout: float) -> Iterator[DataSnapshot]:
+        """
+        Yields initial snapshot if it is given, then loaded or refreshed one, then refreshed
+        one each time worker notifies about new entities on channel or every timeout seconds
+
+        """
+        if self.snapshot is not None:
+            yield self.snapshot
+        for _ in itertools.chain([[]], self.storage.listen(channel, timeout=timeout)):
+            try:
+                snapshot = self.update()
+            except Exception:
+                logging.exception('Failed to update data')
+                continue
+            yield snapshot
@@ -0,0 +1,187 @@
+import os
+import json
+import fcntl
+import time
+import shutil
+import logging
+import datetime
+from typing import Optional, Iterator
+
+import pandas as pd
+import pyarrow.feather as feather
+
+from src.snapshot import DataSnapshot
+
+
+class SnapshotStore:
+    """
+    Directory of published snapshots in Arrow IPC (uncompressed Feather) files.
+    Loader process publishes each snapshot to a new version directory and
+    switches CURRENT file to it, dashboard workers memory-map CURRENT version
+    read-only, so column buffers are shared by all workers via page cache.
+    Latest version is also used for warm restart: it is mapped on start
+    and refreshed with rows added after its watermarks.
+    Only process holding LOCK file should publish, others only read
+
+    """
+
+    path: str
+    keep: int
+    frames = ['posts', 'groups', 'group_entities', 'entities_daily']
+    current_file = 'CURRENT'
+    lock_file = 'LOCK'
+    meta_file = 'meta.json'
+    format_version = 2
+
+    lock_fd: Optional[int]
+
+    def __init__(self, path: str, keep: int = 2):
+        self.path = path
+        self.keep = keep
+        self.lock_fd = None
+        os.makedirs(path, exist_ok=True)
+
+    def try_lock(self) -> bool:
+        """
+        Takes exclusive lock of store for publishing without waiting.
+        Lock is held until process exits, returns True if it is held by this process
+
+        """
+        if self.lock_fd is not None:
+            return True
+        fd = os.open(os.path.join(self.path, self.lock_file), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.lock_fd = fd
+        return True
+
+    def publish(self, snapshot: DataSnapshot) -> str:
+        start = time.time()
+        name = '%d-%d-%d' % (int(snapshot.built_at.timestamp() * 1000), os.getpid(), snapshot.version)
+        if not os.path.isdir(os.path.join(self.path, name)):
+            self.write(snapshot, name)
+        current_tmp_path = os.path.join(self.path, '.%s-%d' % (self.current_file, os.getpid()))
+        with open(current_tmp_path, 'w') as f:
+            f.write(name)
+        os.replace(current_tmp_path, os.path.join(self.path, self.current_file))
+        self.remove_old(name)
+        logging.info('Published snapshot %s in %.1fs' % (name, time.time() - start))
+        return name
+
+    def write(self, snapshot: DataSnapshot, name: str):
+        tmp_path = os.path.join(self.path, '.' + name)
+        os.makedirs(tmp_path)
+        frames = {
+            'posts': snapshot.posts_df,
+            'groups': snapshot.groups_df,
+            'group_entities': snapshot.group_entities_df,
+            'entities_daily': snapshot.entities_daily_df
+        }
+        for frame, df in frames.items():
+            # one record batch per file, so mapped columns are contiguous and converted without copying
+            feather.write_feather(
+                df.reset_index(drop=True), os.path.join(tmp_path, frame + '.arrow'),
+                compression='uncompressed', chunksize=max(len(df), 1))
+        watermarks = snapshot.get_watermarks()
+        with open(os.path.join(tmp_path, self.meta_file), 'w') as f:
+            json.dump({
+                'format_version': self.format_version,
+                'built_at': snapshot.built_at.isoformat(),
+                'loaded_at': snapshot.loaded_at.isoformat(),
+                'posts_watermark': watermarks[0].isoformat() if watermarks else None,
+                'entities_watermark': watermarks[1].isoformat() if watermarks else None
+            }, f)
+        os.rename(tmp_path, os.path.join(self.path, name))
+
+    def remove_old(self, current: str):
+        """
+        Removes all versions except keep latest and one named in CURRENT. Workers
+        still mapping removed version keep reading it until they remap, as unlinked files stay mapped
+
+        """
+        names = sorted(
+            (name for name in os.listdir(self.path)
+             if not name.startswith('.') and os.path.isdir(os.path.join(self.path, name))),
+            key=lambda name: int(name.split('-')[0]))
+        for name in names[:-self.keep]:
+            if name not in (current, self.get_current()):
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def get_current(self) -> Optional[str]:
+        try:
+            with open(os.path.join(self.path, self.current_file)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def get_meta(self, name: str) -> dict:
+        with open(os.path.join(self.path, name, self.meta_file)) as f:
+            return json.load(f)
+
+    def read_frame(self, name: str, frame: str) -> pd.DataFrame:
+        table = feather.read_table(os.path.join(self.path, name, frame + '.arrow'), memory_map=True)
+        return table.to_pandas(split_blocks=True)
+
+    def load(self, name: str) -> DataSnapshot:
+        """
+        Raw entities are not stored: entities joined with groups are used instead,
+        refresh drops group column and duplicates of mention before joining them again
+
+        """
+        start = time.time()
+        meta = self.get_meta(name)
+        posts_df, groups_df, group_entities_df, entities_daily_df = [
+            self.read_frame(name, frame) for frame in self.frames
+        ]
+        snapshot = DataSnapshot(
+            posts_df=posts_df,
+            groups_df=groups_df,
+            entities_df=group_entities_df,
+            entities_daily_df=entities_daily_df,
+            group_entities_df=group_entities_df,
+            loaded_at=datetime.datetime.fromisoformat(meta['loaded_at']))
+        logging.info('Mapped snapshot %s as %d in %.1fs' % (name, snapshot.version, time.time() - start))
+        return snapshot
+
+    def load_latest(self) -> Optional[DataSnapshot]:
+        """
+        Returns snapshot mapped from current version, None if there is
+        no version or it was written in other format or can not be read
+
+        """
+        name = self.get_current()
+        if name is None:
+            return None
+        try:
+            meta = self.get_meta(name)
+            if meta.get('format_version') != self.format_version:
+                logging.info('Skip snapshot %s of format %s' % (name, meta.get('format_version')))
+                return None
+            snapshot = self.load(name)
+        except Exception:
+            logging.exception('Failed to map snapshot %s' % name)
+            return None
+        logging.info('Warm start from snapshot %s with watermarks: posts %s, entities %s' % (
+            name, meta['posts_watermark'], meta['entities_watermark']))
+        return snapshot
+
+    def follow(self, poll_interval: float) -> Iterator[DataSnapshot]:
+        """
+        Yields snapshot mapped from current version each time it is changed,
+        checking CURRENT file every poll_interval seconds
+
+        """
+        current = None
+        while True:
+            try:
+                name = self.get_current()
+                if name is not None and name != current:
+                    snapshot = self.load(name)
+                    current = name
+                    yield snapshot
+            except Exception:
+                logging.exception('Failed to map snapshot')
+            time.sleep(poll_interval)
@@ -0,0 +1,90 @@
+import zlib
+import functools
+from typing import List, Tuple
+
+import numpy as np
+
+Placement = Tuple[str, float, float, float, float, str]
+
+
+class WordCloudLayout:
+    """
+    Deterministic word cloud layout for plotly text scatter.
+    Words are placed from the most frequent one at free position of coarse
+    occupancy grid nearest to the center, shrinking font if word does not fit.
+    Text size is estimated from font size, so no text is rasterized
+
+    """
+
+    width = 600
+    height = 450
+    cell_size = 6
+    max_words = 100
+    max_font_size = 80
+    min_font_size = 1
+    char_width = 0.6
+    line_height = 1.1
+    shrink_factor = 0.9
+
+    @staticmethod
+    def get_color(word: str) -> str:
+        return 'hsl(%d, 80%%, 50%%)' % (zlib.crc32(word.encode('utf-8')) % 360)
+
+    @classmethod
+    def get_frequencies(cls, counts: List[Tuple[str, int]]) -> Tuple[Tuple[str, float], ...]:
+        """
+        Returns top words with frequencies relative to the most frequent one.
+        Counts must be sorted by count descending
+
+        """
+        counts = counts[:cls.max_words]
+        if not counts:
+            return ()
+        max_count = counts[0][1]
+        return tuple((word, round(count / max_count, 3)) for word, count in counts)
+
+    @classmethod
+    def get_text_cells(cls, word: str, font_size: float) -> Tuple[int, int]:
+        rows = int(np.ceil(font_size * cls.line_height / cls.cell_size))
+        cols = int(np.ceil(len(word) * font_size * cls.char_width / cls.cell_size))
+        return max(rows, 1), max(cols, 1)
+
+    @classmethod
+    @functools.lru_cache(maxsize=256)
+    def get_layout(cls, frequencies: Tuple[Tuple[str, float], ...]) -> Tuple[Placement, ...]:
+        """
+        Returns (word, frequency, font size, x, y, color) of placed words, x and y are text centers.
+        Layouts are cached by frequencies, so same top words reuse layout
+
+        """
+        grid_rows, grid_cols = cls.height // cls.cell_size, cls.width // cls.cell_size
+        grid = np.zeros((grid_rows, grid_cols), dtype=np.int32)
+        integral = np.zeros((grid_rows + 1, grid_cols + 1), dtype=np.int32)
+        center_row, center_col = grid_rows / 2, grid_cols / 2
+
+        placements = []
+        for word, frequency in frequencies:
+            font_size = frequency * cls.max_font_size
+            while font_size > cls.min_font_size:
+                rows, cols = cls.get_text_cells(word, font_size)
+                if rows <= grid_rows and cols <= grid_cols:
+                    occupied = (integral[rows:, cols:] - integral[:-rows, cols:]
+                                - integral[rows:, :-cols] + integral[:-rows, :-cols])
+                    if not occupied.all():
+                        top = np.arange(occupied.shape[0])[:, None] + rows / 2 - center_row
+                        left = np.arange(occupied.shape[1])[None, :] + cols / 2 - center_col
+                        distance = (top / grid_rows) ** 2 + (left / grid_cols) ** 2
+                        row, col = np.unravel_index(
+                            np.where(occupied == 0, distance, np.inf).argmin(), occupied.shape)
+                        grid[row:row + rows, col:col + cols] = 1
+                        integral[1:, 1:] = grid.cumsum(axis=0).cumsum(axis=1)
+                        placements.append((
+                            word,
+                            frequency,
+                            font_size,
+                            (col + cols / 2) * cls.cell_size,
+                            cls.height - (row + rows / 2) * cls.cell_size,
+                            cls.get_color(word)))
+                        break
+                font_size *= cls.shrink_factor
+        return tuple(placements)
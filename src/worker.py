@@ -0,0 +1,61 @@
+import time
+import logging
+from typing import Tuple
+
+from src import config as cfg
+from src import migrations
+from src.entities_extractor import EntitiesExtractor
+from src.postgres import Storage
+
+
+def process_posts(storage: Storage, extractor: EntitiesExtractor) -> Tuple[int, int]:
+    total_posts = 0
+    total_entities = 0
+    posts_count = cfg.NER_CLAIM_SIZE
+    while posts_count == cfg.NER_CLAIM_SIZE:
+        posts_count, entities_count = storage.process_unprocessed_posts(
+            extractor.get_entities, cfg.NER_CLAIM_SIZE, cfg.NER_MAX_ATTEMPTS)
+        total_posts += posts_count
+        total_entities += entities_count
+        logging.info('Processed %d new posts, add %d new entities' % (posts_count, entities_count))
+    return total_posts, total_entities
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    extractor = EntitiesExtractor(
+        workers=cfg.NER_WORKERS,
+        batch_size=cfg.NER_BATCH_SIZE,
+        profile=cfg.NER_PROFILE,
+        cache_path=cfg.NER_CACHE_PATH,
+        cache_size=cfg.NER_CACHE_SIZE)
+    storage = Storage.connect(
+        dbname=cfg.PG_NAME,
+        user=cfg.PG_USER,
+        password=cfg.PG_PASS,
+        host=cfg.PG_HOST,
+        port=cfg.PG_PORT,
+        itersize=cfg.PG_ITERSIZE,
+        copy_chunk_size=cfg.PG_COPY_CHUNK_SIZE,
+        minconn=cfg.PG_POOL_MIN,
+        maxconn=cfg.PG_POOL_MAX,
+        retries=cfg.PG_RETRIES,
+        backoff=cfg.PG_BACKOFF)
+    migrations.migrate(storage)
+    try:
+        while True:
+            try:
+                posts_count, entities_count = process_posts(storage, extractor)
+                if posts_count:
+                    storage.refresh_posts_daily_stats()
+                if entities_count:
+                    storage.notify(cfg.ENTITIES_CHANNEL, str(entities_count))
+            except Exception:
+                logging.exception('Failed to process new posts')
+            time.sleep(cfg.NER_PROCESSING_INTERVAL)
+    finally:
+        extractor.close()
+
+
+if __name__ == '__main__':
+    main()